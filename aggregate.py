@@ -0,0 +1,137 @@
+import messages
+
+INF = float("inf")
+
+# seconds per bucket: buckets kept, so a sensor's memory is fixed per resolution
+RESOLUTIONS = {
+    60: 60,      # one hour of minutes
+    3600: 48,    # two days of hours
+}
+
+
+class Series:
+    # fixed ring of time buckets for one sensor at one resolution; a bucket
+    # is a row of per-field count, sum, min, max and last lists. Readers on
+    # other threads take no lock, so a new bucket's row is built and filled
+    # before its start is published, and a last value is set before its count
+
+    def __init__(self, fields, resolution, buckets) -> None:
+        self.fields = tuple(fields)
+        self.resolution = resolution
+        self.buckets = buckets
+        self.start = [-1] * buckets   # bucket start time, -1 while unused
+        self.last_time = [0] * buckets
+        self.rows = [None] * buckets
+        self.empty = ([0] * len(self.fields), [0.0] * len(self.fields), [INF] * len(self.fields), [-INF] * len(self.fields), [None] * len(self.fields))
+
+    def add(self, time_stamp, values):
+        # values in field order, None for a missing field
+        start = time_stamp - time_stamp % self.resolution
+        slot = start // self.resolution % self.buckets
+
+        if self.start[slot] > start:
+            return  # older than the window
+
+        new = self.start[slot] < start
+        if new:
+            row = [list(empty) for empty in self.empty]
+            latest = True
+        else:
+            row = self.rows[slot]
+            latest = time_stamp >= self.last_time[slot]
+
+        counts, sums, mins, maxs, lasts = row
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            if latest or lasts[i] is None:
+                lasts[i] = value
+            sums[i] += value
+            if value < mins[i]:
+                mins[i] = value
+            if value > maxs[i]:
+                maxs[i] = value
+            counts[i] += 1
+
+        if latest:
+            self.last_time[slot] = time_stamp
+        if new:
+            self.rows[slot] = row
+            self.start[slot] = start
+
+    def slots(self, start, end):
+        # used slots with start <= bucket start <= end, oldest first
+        return sorted((self.start[slot], slot) for slot in range(self.buckets)
+                      if self.start[slot] >= 0 and start <= self.start[slot] <= end)
+
+    def query(self, start=0, end=None, fields=None):
+        end = end if end is not None else 1 << 62
+        return [(bucket_start, self.statistics([slot], fields)) for bucket_start, slot in self.slots(start, end)]
+
+    def summary(self, start=0, end=None, fields=None):
+        # one set of statistics over every bucket in the range
+        end = end if end is not None else 1 << 62
+        slots = [slot for bucket_start, slot in self.slots(start, end)]
+        return self.statistics(slots, fields) if slots else {}
+
+    def statistics(self, slots, fields=None):
+        rows = [self.rows[slot] for slot in sorted(slots, key=lambda slot: self.last_time[slot])]
+        rows = [row for row in rows if row is not None]
+        result = {}
+
+        for i, field in enumerate(self.fields):
+            count = sum(row[0][i] for row in rows)
+            lasts = [row[4][i] for row in rows if row[4][i] is not None]
+            if not count or not lasts or (fields is not None and field not in fields):
+                continue
+            result[field] = {
+                "count": count,
+                "mean": sum(row[1][i] for row in rows) / count,
+                "min": min(row[2][i] for row in rows),
+                "max": max(row[3][i] for row in rows),
+                "last": lasts[-1],
+            }
+
+        return result
+
+
+class Aggregator:
+
+    def __init__(self, resolutions=RESOLUTIONS) -> None:
+        self.resolutions = dict(resolutions)
+        self.series = {}   # sensor_id -> {resolution: Series}
+        self.fields = {}   # sensor_id -> field order of its series
+
+    def __contains__(self, sensor_id):
+        return sensor_id in self.series
+
+    def add(self, sensor_id, time_stamp, data):
+        series = self.series.get(sensor_id)
+        if series is None:
+            fields = fields_for(sensor_id, data)
+            series = self.series[sensor_id] = {resolution: Series(fields, resolution, buckets) for resolution, buckets in self.resolutions.items()}
+            self.fields[sensor_id] = fields
+        values = [data.get(field) for field in self.fields[sensor_id]]
+        for ring in series.values():
+            ring.add(time_stamp, values)
+
+    def query(self, sensor_id, resolution, start=0, end=None, fields=None):
+        # [(bucket start, {field: {count, mean, min, max, last}})]
+        series = self.series.get(sensor_id)
+        if series is None or resolution not in series:
+            return []
+        return series[resolution].query(start, end, fields)
+
+    def summary(self, sensor_id, resolution, start=0, end=None, fields=None):
+        series = self.series.get(sensor_id)
+        if series is None or resolution not in series:
+            return {}
+        return series[resolution].summary(start, end, fields)
+
+
+def fields_for(sensor_id, data):
+    schema = messages.payload_schemas.get(messages.sensor_type(sensor_id))
+
+    if schema is not None:
+        return schema[1]
+    return sorted(key for key, value in data.items() if isinstance(value, (int, float)))
@@ -0,0 +1,293 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import socket
+import subprocess
+import time
+import timeit
+import zlib
+
+import delta
+import messages
+import output
+import server
+import tester
+
+SENSORS = list(messages.sensors_map)
+CONTROL = {"ack": {"ack": 1}, "error": {"error": 1}, "activity": {"activity": 1}}
+
+
+class NullServer:
+
+    def send_response(self, data, client):
+        pass
+
+
+def measure(function, number):
+    # best of three runs, in microseconds per call
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def sample_messages(fmt):
+    samples = {}
+
+    for sensor_id in SENSORS:
+        data = tester.create_data(sensor_id)
+        samples[f"data/{sensor_id}"] = messages.sensor_message(sensor_id, 1792000000000, data, "high", "data", 0, fmt, 1)
+
+    for msg_type, data in CONTROL.items():
+        samples[msg_type] = messages.sensor_message("ThermoNode", 1792000000000, data, "high", msg_type, 0, fmt, 1)
+
+    if fmt != "legacy":
+        readings = [messages.reading(f"{SENSORS[i % 4]}-{i}", 1792000000000 + i, tester.create_data(SENSORS[i % 4]), "high", i) for i in range(64)]
+        samples["batch"] = messages.batch_message("Gateway", messages.split_batch("Gateway", readings, fmt)[0], fmt, 1)
+
+    samples["registration"] = messages.registration_message("ThermoNode", None, messages.FORMATS, "legacy" if fmt == "legacy" else "json")
+    return samples
+
+
+def bench_codec(number):
+    # every installed json serializer, keys of the non-default ones end in @name
+    results = {}
+    default = messages.SERIALIZER
+
+    for serializer in messages.serializers:
+        messages.use_serializer(serializer)
+        suffix = "" if serializer == "json" else f"@{serializer}"
+        results.update(bench_codec_formats(number, suffix))
+
+    messages.use_serializer(default)
+    return results
+
+
+def bench_codec_formats(number, suffix):
+    results = {}
+
+    for fmt in messages.FORMATS:
+        for name, sample in sample_messages(fmt).items():
+            raw = sample.encode("utf-8") if isinstance(sample, str) else sample
+            dictionary = messages.load(raw)[0]
+            encode_fmt = "json" if name == "registration" and fmt == "binary" else fmt
+
+            results[f"{fmt}/{name}{suffix}"] = {
+                "bytes": len(raw),
+                "encode_us": measure(lambda: messages.dump(dictionary, encode_fmt), number),
+                "decode_us": measure(lambda: messages.load(raw), number),
+                "crc_us": measure(lambda: zlib.crc32(raw), number),
+            }
+
+            if name in CONTROL:
+                templates = {}
+                results[f"{fmt}/{name}{suffix}"]["template_us"] = measure(lambda: messages.control_message("ThermoNode", 1792000000000, "high", name, 1792000000, fmt, 1, templates), number)
+
+    return results
+
+
+def bench_delta(number):
+    # a reading one step away from its acked base against the same reading as a keyframe
+    results = {}
+    token = 1792000000000
+
+    for sensor_id in SENSORS:
+        data = tester.create_data(sensor_id)
+        field = messages.payload_schemas[sensor_id][1][0]
+        step = dict(data, **{field: data[field] + 1})
+
+        encoder = delta.Encoder(sensor_id, token)
+        decoder = delta.Decoder()
+        decoder.register(token, sensor_id)
+        keyframe = encoder.encode(data, "high", 1, 1792000000)
+        encoder.acked(1)
+        decoder.acked(token, 1, 1792000000, data)
+        packet = encoder.encode(step, "high", 2, 1792000005)
+
+        def encode():
+            encoder.deltas = 0
+            encoder.encode(step, "high", 2, 1792000005)
+
+        results[f"delta/{sensor_id}"] = {
+            "bytes": len(packet),
+            "keyframe_bytes": len(keyframe),
+            "binary_bytes": len(messages.sensor_message(sensor_id, token, step, "high", "data", 0, "binary", 2)),
+            "json_bytes": len(messages.sensor_message(sensor_id, token, step, "high", "data", 0, "json", 2)),
+            "encode_us": measure(encode, number),
+            "decode_us": measure(lambda: decoder.load(packet), number),
+        }
+
+    return results
+
+
+def bench_handlers(number):
+    results = {}
+    null = NullServer()
+    client = ("127.0.0.1", 9)
+    server.outputs = output.Pipeline([])
+
+    for fmt in messages.FORMATS:
+        for sensor_id in SENSORS:
+            registration = messages.registration_message(sensor_id, None, (fmt,), "legacy" if fmt == "legacy" else "json")
+            server.process_message(registration.encode("utf-8"), null, client)
+            token = server.sensors.get(sensor_id).token
+
+            # a new seq per call, a replayed one would only time the duplicate check
+            packets = []
+            for seq in range(1, 3 * number + 1):
+                data = messages.sensor_message(sensor_id, token, tester.create_data(sensor_id), "high", "data", 0, fmt, seq)
+                packets.append(data.encode("utf-8") if isinstance(data, str) else data)
+            packets = iter(packets)
+
+            def run():
+                server.process_message(next(packets), null, client)
+                server.outputs.drain()
+
+            results[f"{fmt}/data/{sensor_id}"] = {"process_us": measure(run, number)}
+
+    return results
+
+
+def serve(port, ready):
+    server.outputs = output.Pipeline([])
+    srv = server.Server("127.0.0.1", port)
+    ready.set()
+    asyncio.run(server.serve(srv))
+
+
+def bench_loopback(port, count, window, fmt):
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve, args=(port, ready), daemon=True)
+    process.start()
+    ready.wait()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(("127.0.0.1", port))
+    sock.settimeout(1.0)
+
+    try:
+        sock.send(messages.registration_message("ThermoNode", None, (fmt,)).encode("utf-8"))
+        token = messages.load(sock.recv(2048))[0]["header"]["token"]
+
+        def data(seq):
+            msg = messages.sensor_message("ThermoNode", token, tester.create_data("ThermoNode"), "high", "data", 0, fmt, seq)
+            return msg.encode("utf-8") if isinstance(msg, str) else msg
+
+        latencies = []
+        for seq in range(1, count // 10 + 1):
+            payload = data(seq)
+            start = time.perf_counter()
+            sock.send(payload)
+            sock.recv(2048)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+
+        # seqs after the ones the latency run stored, or every reading is a duplicate
+        payloads = [data(seq) for seq in range(count // 10 + 1, count // 10 + 1 + count)]
+        acked = 0
+        in_flight = 0
+        start = time.perf_counter()
+        for payload in payloads:
+            if in_flight >= window:
+                try:
+                    sock.recv(2048)
+                    acked += 1
+                except socket.timeout:
+                    pass
+                in_flight -= 1
+            sock.send(payload)
+            in_flight += 1
+        while in_flight:
+            try:
+                sock.recv(2048)
+                acked += 1
+            except socket.timeout:
+                break
+            in_flight -= 1
+        elapsed = time.perf_counter() - start
+    finally:
+        sock.close()
+        process.terminate()
+        process.join()
+
+    return {
+        "format": fmt,
+        "sent": count,
+        "acked": acked,
+        "throughput_per_s": acked / elapsed,
+        "rtt_us": {name: latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1e6
+                   for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))},
+    }
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def serializer_gains(codec):
+    # stdlib time / other backend time per message type
+    for name, values in codec.items():
+        if "@" not in name:
+            continue
+        base = codec[name.split("@")[0]]
+        print(f" codec/{name}: encode {base['encode_us'] / values['encode_us']:.2f}x, decode {base['decode_us'] / values['decode_us']:.2f}x faster than json")
+
+
+def compare(results, baseline):
+    # ratio new / old for every timing present in both runs
+    for section in ("codec", "delta", "handlers"):
+        for name, values in results.get(section, {}).items():
+            old = baseline.get(section, {}).get(name)
+            if old is None:
+                continue
+            for key, value in values.items():
+                if key.endswith("_us") and old.get(key):
+                    print(f" {section}/{name} {key}: {old[key]:.2f} -> {value:.2f} ({value / old[key]:.2f}x)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the message pipeline")
+    parser.add_argument("--number", type=int, default=2000, help="calls per micro-benchmark run")
+    parser.add_argument("--loopback", type=int, default=20000, help="datagrams for the loopback benchmark, 0 skips it")
+    parser.add_argument("--window", type=int, default=64, help="datagrams in flight during the loopback benchmark")
+    parser.add_argument("--port", type=int, default=50505)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    options = parser.parse_args(argv)
+
+    results = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "serializer": messages.SERIALIZER,
+        "time": int(time.time()),
+        "codec": bench_codec(options.number),
+        "delta": bench_delta(options.number),
+        "handlers": bench_handlers(options.number),
+        "loopback": [],
+    }
+
+    if options.loopback:
+        for offset, fmt in enumerate(messages.FORMATS):
+            results["loopback"].append(bench_loopback(options.port + offset, options.loopback, options.window, fmt))
+
+    with open(options.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    for section in ("codec", "delta", "handlers"):
+        for name, values in results[section].items():
+            print(f" {section}/{name}: " + ", ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}" for key, value in values.items()))
+    serializer_gains(results["codec"])
+    for run in results["loopback"]:
+        print(f" loopback/{run['format']}: {run['throughput_per_s']:.0f}/s, rtt p50 {run['rtt_us']['p50']:.0f}us, p99 {run['rtt_us']['p99']:.0f}us, acked {run['acked']}/{run['sent']}")
+
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import socket
+import struct
+
+MAGIC = b"PKSCAP1\n"
+BUFFERING = 1 << 20
+
+# receive time in microseconds since the epoch, source ipv4 address and port, datagram length
+RECORD = struct.Struct("<q4sHH")
+
+
+class Capture:
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.file = open(path, "ab", buffering=BUFFERING)
+        self.count = 0
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write(self, time_us, data, client):
+        self.file.write(RECORD.pack(time_us, socket.inet_aton(client[0]), client[1], len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read(path):
+    # (time_us, client, data) for every complete record, a torn tail is skipped
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            time_us, address, port, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield time_us, (socket.inet_ntoa(address), port), data
@@ -0,0 +1,183 @@
+import struct
+import zlib
+
+import messages
+
+VERSION = 1
+KEYFRAME_INTERVAL = 32   # deltas between keyframes
+WINDOW = 16              # acked readings a decoder keeps per token as bases
+SENT_LIMIT = 64          # unacked readings an encoder remembers
+
+FLAG_KEYFRAME = 1
+FLAG_LOW_BATTERY = 2
+
+# magic, version, flags, token, seq; the token stands in for the sensor id.
+# A keyframe goes on with the time stamp and the schema payload, a delta with
+# varints: seq distance to its base, zigzag time change, a bit per changed
+# field (bit i is field id i of the schema) and a zigzag change per set bit
+HEADER = struct.Struct("<BBBQI")
+KEYFRAME_TIME = struct.Struct("<I")
+CRC = struct.Struct("<I")
+
+
+class Encoder:
+    # one per sensor on the sending side; sent readings are kept until acked
+    # and the newest acked one is the base of the next delta
+
+    def __init__(self, sensor_id, token, interval=KEYFRAME_INTERVAL) -> None:
+        self.token = token
+        self.layout, self.fields, self.scales = messages.payload_schemas[messages.sensor_type(sensor_id)]
+        self.interval = interval
+        self.sent = {}      # seq -> (time_stamp, scaled values) awaiting an ack
+        self.base = None    # (seq, time_stamp, scaled values) of the newest acked reading
+        self.deltas = interval  # deltas since the last keyframe, full so the first is a keyframe
+
+    def encode(self, data, battery, seq, timestamp=0):
+        time_stamp = timestamp or messages.getTime()
+        values = [round(data[field] * scale) for field, scale in zip(self.fields, self.scales)]
+        flags = FLAG_LOW_BATTERY if battery == "low" else 0
+        base = self.base
+
+        if base is None or self.deltas >= self.interval or seq <= base[0]:
+            packet = HEADER.pack(messages.DELTA_MAGIC, VERSION, flags | FLAG_KEYFRAME, self.token, seq) + KEYFRAME_TIME.pack(time_stamp) + self.layout.pack(*values)
+            self.deltas = 0
+        else:
+            packet = bytearray(HEADER.pack(messages.DELTA_MAGIC, VERSION, flags, self.token, seq))
+            put_varint(packet, seq - base[0])
+            put_varint(packet, zigzag(time_stamp - base[1]))
+            mask = len(packet)
+            packet.append(0)
+            for i, (value, previous) in enumerate(zip(values, base[2])):
+                if value != previous:
+                    packet[mask] |= 1 << i
+                    put_varint(packet, zigzag(value - previous))
+            self.deltas += 1
+
+        if len(self.sent) >= SENT_LIMIT:
+            del self.sent[next(iter(self.sent))]
+        self.sent[seq] = (time_stamp, values)
+
+        return bytes(packet) + CRC.pack(zlib.crc32(packet))
+
+    def acked(self, seq):
+        reading = self.sent.pop(seq, None)
+        if reading is not None and (self.base is None or seq > self.base[0]):
+            self.base = (seq,) + reading
+
+    def keyframe(self):
+        # the receiver lost our base, start over with a keyframe
+        self.deltas = self.interval
+
+
+class Stream:
+
+    __slots__ = ("sensor_id", "layout", "fields", "scales", "readings")
+
+    def __init__(self, sensor_id) -> None:
+        self.sensor_id = sensor_id
+        self.layout, self.fields, self.scales = messages.payload_schemas[messages.sensor_type(sensor_id)]
+        self.readings = {}  # seq -> (time_stamp, scaled values) of acked readings
+
+
+class Decoder:
+    # receiving side: per token the sensor it belongs to and its last WINDOW
+    # acked readings, which are the only bases a delta may refer to
+
+    def __init__(self, window=WINDOW) -> None:
+        self.window = window
+        self.streams = {}   # token -> Stream
+
+    def __contains__(self, token):
+        return token in self.streams
+
+    def register(self, token, sensor_id):
+        self.streams[token] = Stream(sensor_id)
+
+    def forget(self, token):
+        self.streams.pop(token, None)
+
+    def acked(self, token, seq, time_stamp, data):
+        stream = self.streams.get(token)
+        if stream is None or seq is None:
+            return
+        stream.readings[seq] = (time_stamp, [round(data[field] * scale) for field, scale in zip(stream.fields, stream.scales)])
+        if len(stream.readings) > self.window:
+            del stream.readings[min(stream.readings)]
+
+    def load(self, data):
+        # same result as messages.load; a delta whose base is gone comes back
+        # invalid, like a corrupted datagram, so the sender is asked to resend
+        try:
+            magic, version, flags, token, seq = HEADER.unpack_from(data)
+            stream = self.streams.get(token)
+            if version != VERSION or stream is None:
+                return None, False
+
+            offset = HEADER.size
+            if flags & FLAG_KEYFRAME:
+                base = None
+                time_stamp, = KEYFRAME_TIME.unpack_from(data, offset)
+                values = stream.layout.unpack_from(data, offset + KEYFRAME_TIME.size)
+                offset += KEYFRAME_TIME.size + stream.layout.size
+            else:
+                distance, offset = get_varint(data, offset)
+                change, offset = get_varint(data, offset)
+                mask = data[offset]
+                offset += 1
+                base = stream.readings.get(seq - distance)
+                time_stamp = base[0] + unzigzag(change) if base is not None else 0
+                values = list(base[1]) if base is not None else [0] * len(stream.fields)
+                for i in range(len(stream.fields)):
+                    if mask >> i & 1:
+                        change, offset = get_varint(data, offset)
+                        values[i] += unzigzag(change)
+
+            crc, = CRC.unpack_from(data, offset)
+        except (struct.error, IndexError):
+            return None, False
+
+        dictionary = {
+            "header": {
+                "msg_type": "data",
+                "time_stamp": time_stamp,
+                "sensor_id": stream.sensor_id,
+                "battery": "low" if flags & FLAG_LOW_BATTERY else "high",
+                "token": token,
+                "crc": crc,
+                "data": {field: value if scale == 1 else value / scale for field, value, scale in zip(stream.fields, values, stream.scales)},
+                "seq": seq,
+            }
+        }
+
+        valid = crc == zlib.crc32(data[:offset]) and (flags & FLAG_KEYFRAME or base is not None)
+        return dictionary, bool(valid)
+
+
+def is_delta(data):
+    return data[:1] == bytes([messages.DELTA_MAGIC])
+
+
+def zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def put_varint(packet, n):
+    while n > 0x7F:
+        packet.append(n & 0x7F | 0x80)
+        n >>= 7
+    packet.append(n)
+
+
+def get_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+
+import delta
+import messages
+import tester
+
+REGISTER_TIMEOUT = 1.0
+REGISTER_ATTEMPTS = 3
+REGISTER_BURST = 200  # registrations in flight per process
+TICK = 0.01           # seconds between send rounds
+
+
+class LoadProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, generator) -> None:
+        self.generator = generator
+
+    def datagram_received(self, data, addr):
+        self.generator.received(data)
+
+
+class Generator:
+
+    def __init__(self, options, sensor_ids, index=0) -> None:
+        self.options = options
+        self.sensor_ids = sensor_ids
+        self.random = random.Random(options.seed + index)
+        self.transport = None
+        self.sensors = {}        # sensor_id -> tester.VirtualSensor
+        self.encoders = {}       # sensor_id -> delta.Encoder for sensors in the delta format
+        self.waiting = {}        # sensor_id -> future for the registration reply
+        self.sent_at = {}        # (sensor_id, seq) -> monotonic send time
+        self.latencies = []
+        self.held = None         # datagram delayed to reorder it behind the next one
+        self.stats = {"sent": 0, "dropped": 0, "corrupted": 0, "reordered": 0, "acked": 0, "errors": 0, "registered": 0, "slowdowns": 0, "bytes_sent": 0}
+        self.slow_until = 0.0    # monotonic time the server asked us to hold back until
+
+    def received(self, data):
+        dictionary, valid = messages.load(data)
+        if dictionary is None or not valid:
+            return
+        header = dictionary["header"]
+        msg_type = header["msg_type"]
+
+        if msg_type == "registration":
+            future = self.waiting.pop(header["sensor_id"], None)
+            if future is not None and not future.done():
+                future.set_result(header)
+        elif msg_type == "ack":
+            sent_at = self.sent_at.pop((header["sensor_id"], header.get("seq")), None)
+            if sent_at is not None:
+                self.latencies.append(time.monotonic() - sent_at)
+                self.stats["acked"] += 1
+            if header["sensor_id"] in self.encoders:
+                self.encoders[header["sensor_id"]].acked(header.get("seq"))
+        elif msg_type == "error":
+            self.stats["errors"] += 1
+            if header["sensor_id"] in self.encoders:
+                self.encoders[header["sensor_id"]].keyframe()
+        elif msg_type == "slow_down":
+            self.stats["slowdowns"] += 1
+            self.slow_until = time.monotonic() + header["data"]["slow_down"]
+
+    def send(self, msg):
+        if isinstance(msg, str):
+            msg = msg.encode("utf-8")
+        self.stats["bytes_sent"] += len(msg)
+        self.transport.sendto(msg)
+
+    async def register(self, sensor_id):
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(REGISTER_ATTEMPTS):
+            future = self.waiting[sensor_id] = loop.create_future()
+            self.send(messages.registration_message(sensor_id, None, (self.options.format,)))
+            try:
+                header = await asyncio.wait_for(future, REGISTER_TIMEOUT)
+            except asyncio.TimeoutError:
+                continue
+            fmt = header["data"].get("formats", ["legacy"])[0]
+            self.sensors[sensor_id] = tester.VirtualSensor(header["token"], fmt)
+            if fmt == "delta":
+                self.encoders[sensor_id] = delta.Encoder(sensor_id, header["token"])
+            self.stats["registered"] += 1
+            return
+
+    def reading(self, sensor_id):
+        sensor = self.sensors[sensor_id]
+        sensor.seq += 1
+        if sensor_id in self.encoders:
+            msg = self.encoders[sensor_id].encode(tester.create_data(sensor_id), sensor.battery, sensor.seq)
+        else:
+            msg = messages.sensor_message(sensor_id, sensor.token, tester.create_data(sensor_id), sensor.battery, "data", 0, sensor.format, sensor.seq)
+        options = self.options
+
+        self.stats["sent"] += 1
+
+        if self.random.random() < options.corrupt:
+            self.stats["corrupted"] += 1
+            msg = tester.corrupt(msg, sensor.format)
+        else:
+            self.sent_at[(sensor_id, sensor.seq)] = time.monotonic()
+
+        if self.random.random() < options.loss:
+            self.stats["dropped"] += 1
+            return
+
+        if self.held is not None:
+            self.send(msg)
+            self.send(self.held)
+            self.held = None
+        elif self.random.random() < options.reorder:
+            self.stats["reordered"] += 1
+            self.held = msg
+        else:
+            self.send(msg)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        options = self.options
+
+        self.transport, protocol = await loop.create_datagram_endpoint(lambda: LoadProtocol(self), remote_addr=(options.server_ip, options.server_port))
+
+        for first in range(0, len(self.sensor_ids), REGISTER_BURST):
+            await asyncio.gather(*[self.register(sensor_id) for sensor_id in self.sensor_ids[first:first + REGISTER_BURST]])
+
+        registered = list(self.sensors)
+        rate = options.rate * len(registered)  # readings per second for this process
+        start = time.monotonic()
+        due = 0.0
+        sent = 0
+
+        while registered and time.monotonic() - start < options.duration:
+            await asyncio.sleep(TICK)
+            due = (time.monotonic() - start) * rate
+            held = time.monotonic() < self.slow_until  # readings due while held back are skipped, not queued
+            while sent < due:
+                if not held:
+                    self.reading(registered[sent % len(registered)])
+                sent += 1
+
+        self.stats["elapsed"] = time.monotonic() - start
+        if self.held is not None:
+            self.send(self.held)
+
+        await asyncio.sleep(options.drain)
+        self.transport.close()
+
+        return self.stats, self.latencies
+
+
+def worker(options, sensor_ids, index, results):
+    results.put(asyncio.run(Generator(options, sensor_ids, index).run()))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summary(results):
+    stats = {}
+    latencies = []
+    elapsed = 0.0
+
+    for worker_stats, worker_latencies in results:
+        elapsed = max(elapsed, worker_stats.pop("elapsed", 0.0))
+        for key, value in worker_stats.items():
+            stats[key] = stats.get(key, 0) + value
+        latencies.extend(worker_latencies)
+
+    latencies.sort()
+    expected = stats.get("sent", 0) - stats.get("corrupted", 0)
+
+    stats["elapsed"] = elapsed
+    stats["send_rate"] = stats.get("sent", 0) / elapsed if elapsed else 0.0
+    stats["loss"] = 1 - stats.get("acked", 0) / expected if expected else 0.0
+    stats["latency_ms"] = {name: percentile([latency * 1000 for latency in latencies], fraction)
+                           for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))}
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate many sensors against a running server")
+    parser.add_argument("server_ip")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("--sensors", type=int, default=1000, help="virtual sensors in total")
+    parser.add_argument("--rate", type=float, default=1 / 15, help="readings per sensor per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of sending")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--format", choices=messages.FORMATS + messages.STATEFUL_FORMATS, default="binary")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="probability a datagram is corrupted")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability a datagram is never sent")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability a datagram is swapped with the next one")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for ACKs after sending")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the summary to this file")
+    options = parser.parse_args(argv)
+
+    kinds = list(messages.sensors_map)
+    sensor_ids = [f"{kinds[i % len(kinds)]}-{i}" for i in range(options.sensors)]
+    shares = [sensor_ids[i::options.processes] for i in range(options.processes)]
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(options, share, index, results)) for index, share in enumerate(shares) if share]
+    for process in processes:
+        process.start()
+    stats = summary([results.get() for process in processes])
+    for process in processes:
+        process.join()
+
+    print(json.dumps(stats, indent=2))
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+
+    return stats
+
+
+if __name__ == "__main__":
+    main()
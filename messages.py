@@ -1,18 +1,116 @@
 import json
 import socket
-import crc
 import asyncio
 import threading
 import time
 import random
+import struct
+import zlib
 
-CRC_CALCULATOR = crc.Calculator(crc.Crc32.CRC32)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FORMATS = ("binary", "json", "legacy")  # preference order offered at registration
+STATEFUL_FORMATS = ("delta",)           # negotiated only when a sensor with a payload schema asks
+
+CRC_TRAILER = b"|"  # json body + "|" + 8 hex digits of crc32(body)
+CRC_TRAILER_SIZE = 9
+
+MAX_DATAGRAM = 1400 # bytes, batches are split to stay under the path MTU
+BATCH_MAX = 64      # readings per batch, one bit each in the batch ack
+
+TIME_MARK = 3987654321  # placeholders located in a rendered template
+SEQ_MARK = 3876543219
+
+### binary
+BINARY_MAGIC = 0xB5
+BINARY_VERSION = 2
+DELTA_MAGIC = 0xB6  # delta coded readings, see delta.py
+
+# magic, version, msg_type, sensor_type, battery, flags, time_stamp, token, seq
+BINARY_HEADER = struct.Struct("<BBBBBBIQI")
+BINARY_CONTROL = struct.Struct("<BB")
+BINARY_BITMAP = struct.Struct("<Q")
+BINARY_CRC = struct.Struct("<I")
+
+# per batch reading: sensor_type, battery, time_stamp, token, seq
+BATCH_ENTRY = struct.Struct("<BBIQI")
+UNKNOWN_SENSOR = 255
+
+FLAG_TOKEN = 1
+FLAG_SCHEMA = 2
+FLAG_SEQ = 4
+
+sensors_map = {
+    "ThermoNode": 0,
+    "WindSense" : 1,
+    "RainDetect": 2,
+    "AirQualityBox": 3
+}
+
+msg_type_map = {
+    "error": 0,
+    "activity": 1,
+    "ack": 2,
+    "data": 3,
+    "registration": 4,
+    "batch": 5,
+    "batch_ack": 6,
+    "slow_down": 7
+}
+
+battery_map = {
+    "high": 0,
+    "low": 1
+}
+
+control_keys = ("registration", "ack", "error", "activity", "active", "slow_down")
+
+# sensor type: (struct, fields, scale) - readings travel as scaled integers
+payload_schemas = {
+    "ThermoNode": (struct.Struct("<hHhI"), ("temperature", "humidity", "dew_point", "pressure"), (10, 10, 10, 100)),
+    "WindSense": (struct.Struct("<HHHB"), ("wind_speed", "wind_gust", "wind_direction", "turbulence"), (10, 10, 1, 10)),
+    "RainDetect": (struct.Struct("<HHBB"), ("rainfall", "soil_moisture", "flood_risk", "rain_duration"), (10, 10, 1, 1)),
+    "AirQualityBox": (struct.Struct("<HHH"), ("co2", "ozone", "air_quality_index"), (1, 10, 1))
+}
+
+sensors_names = {value: key for key, value in sensors_map.items()}
+msg_type_names = {value: key for key, value in msg_type_map.items()}
+battery_names = {value: key for key, value in battery_map.items()}
+### json serializers, name: (encode, decode); encode returns compact utf-8
+# with sorted keys. CRCs cover the bytes on the wire, so backends may differ in
+# escaping and float spelling, except for legacy messages which are checked by
+# re-encoding and therefore always use the standard library
+def stdlib_encode(obj):
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+serializers = {"json": (stdlib_encode, json.loads)}
+
+if orjson is not None:
+    serializers["orjson"] = (lambda obj: orjson.dumps(obj, option=orjson.OPT_SORT_KEYS), orjson.loads)
+
+SERIALIZER = "orjson" if orjson is not None else "json"
+json_encode, json_decode = serializers[SERIALIZER]
+
+def use_serializer(name):
+    global SERIALIZER, json_encode, json_decode
+    
+    json_encode, json_decode = serializers[name]
+    SERIALIZER = name
+
+###binary
 
 def getTime():
     return int(time.time())
 
 
-def registration_message(sensor_id, token):
+def sensor_type(sensor_id):
+    return sensor_id.split("-", 1)[0] # "ThermoNode-17" is a ThermoNode
+
+
+def registration_message(sensor_id, token, formats=FORMATS, fmt="json"):
     
     message = {
         "header": {
@@ -22,13 +120,13 @@ def registration_message(sensor_id, token):
         "battery": "high",
         "token": token,
         "crc": "",
-        "data": {"registration": 1}
+        "data": {"registration": 1, "formats": list(formats)}
         }
     }
     
-    return json_dump(message)
+    return dump(message, fmt)
 
-def sensor_message(sensor_id, token, data, battery, msg_type, timestamp):
+def sensor_message(sensor_id, token, data, battery, msg_type, timestamp, fmt="json", seq=None):
     
     if timestamp == 0:
         time_stamp = getTime()
@@ -46,14 +144,331 @@ def sensor_message(sensor_id, token, data, battery, msg_type, timestamp):
         }
     }
     
+    if seq is not None:
+        message["header"]["seq"] = seq
+    
+    return dump(message, fmt)
+
+class Template:
+    # one control reply (ack, error, activity) rendered once per sensor; the
+    # static bytes and the crc32 state of the leading ones are kept and only
+    # the time stamp and seq are spliced in per message
+
+    def __init__(self, sensor_id, token, battery, msg_type, fmt, has_seq) -> None:
+        self.args = (sensor_id, token, {msg_type: 1}, battery, msg_type)
+        self.fmt = fmt
+        self.has_seq = has_seq
+        self.prefix = None  # None renders every message through sensor_message
+        
+        rendered = sensor_message(sensor_id, token, {msg_type: 1}, battery, msg_type, TIME_MARK, fmt, SEQ_MARK if has_seq else None)
+        
+        if fmt == "binary":
+            fields = BINARY_HEADER.unpack_from(rendered)
+            self.prefix = fields[:6]
+            self.token = fields[7]
+            self.suffix = rendered[BINARY_HEADER.size:-BINARY_CRC.size]
+        elif fmt == "json":
+            body = rendered[:-CRC_TRAILER_SIZE].encode("utf-8")
+            time_mark = b"%d" % TIME_MARK
+            seq_mark = b"%d" % SEQ_MARK
+            
+            if body.count(time_mark) != 1 or body.count(seq_mark) != has_seq:
+                return
+            
+            # sort_keys puts "seq" before "time_stamp"
+            head, self.suffix = body.split(time_mark)
+            if has_seq:
+                head, self.middle = head.split(seq_mark)
+            self.prefix = head
+            self.crc = zlib.crc32(head)
+
+    def encode(self, time_stamp, seq=None):
+        if self.prefix is None or type(time_stamp) is not int or (seq is None) == self.has_seq:
+            return sensor_message(*self.args, time_stamp, self.fmt, seq)
+        
+        if self.fmt == "binary":
+            packet = BINARY_HEADER.pack(*self.prefix, time_stamp, self.token, seq or 0) + self.suffix
+            return packet + BINARY_CRC.pack(zlib.crc32(packet))
+        
+        if self.has_seq:
+            rest = b"%d%s%d%s" % (seq, self.middle, time_stamp, self.suffix)
+        else:
+            rest = b"%d%s" % (time_stamp, self.suffix)
+        return b"%s%s|%08x" % (self.prefix, rest, zlib.crc32(rest, self.crc))
+
+def control_message(sensor_id, token, battery, msg_type, timestamp, fmt="json", seq=None, templates=None):
+    # sensor_message(..., {msg_type: 1}, ...) through a Template kept in
+    # `templates`, the sensor's own dict (registry.SensorState.templates)
+    if fmt == "delta":
+        fmt = "binary"
+    if fmt == "legacy" or templates is None or battery not in battery_map:
+        return sensor_message(sensor_id, token, {msg_type: 1}, battery, msg_type, timestamp, fmt, seq)
+    
+    key = (battery, msg_type, fmt, seq is not None)
+    template = templates.get(key)
+    
+    if template is None:
+        template = templates[key] = Template(sensor_id, token, battery, msg_type, fmt, seq is not None)
+    
+    return template.encode(timestamp or getTime(), seq)
+
+def reading(sensor_id, token, data, battery, seq, timestamp=0):
+    return {
+        "sensor_id": sensor_id,
+        "token": token,
+        "seq": seq,
+        "time_stamp": timestamp or getTime(),
+        "battery": battery,
+        "data": data
+    }
+
+def batch_message(gateway_id, readings, fmt="json", seq=None):
+    return sensor_message(gateway_id, None, {"readings": readings}, "high", "batch", 0, fmt, seq)
+
+def batch_ack_message(gateway_id, bitmap, timestamp, fmt="json", seq=None):
+    return sensor_message(gateway_id, None, {"batch": bitmap}, "high", "batch_ack", timestamp, fmt, seq)
+
+def reading_size(entry, fmt="json"):
+    if fmt == "binary":
+        return BATCH_ENTRY.size + 1 + len(entry["sensor_id"].encode("utf-8")) + payload_schemas[sensor_type(entry["sensor_id"])][0].size
+    return len(json_encode(entry)) + 1
+
+def split_batch(gateway_id, readings, fmt="json"):
+    # group readings so every batch datagram fits in MAX_DATAGRAM
+    budget = MAX_DATAGRAM - len(batch_message(gateway_id, [], fmt, 0)) - 16
+    batches = []
+    batch, size = [], 0
+    
+    for entry in readings:
+        entry_size = reading_size(entry, fmt)
+        if batch and (size + entry_size > budget or len(batch) == BATCH_MAX):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(entry)
+        size += entry_size
+    
+    if batch:
+        batches.append(batch)
+    return batches
+
+def format_of(data):
+    if data[:1] == bytes([BINARY_MAGIC]):
+        return "binary"
+    if data[:1] == bytes([DELTA_MAGIC]):
+        return "delta"
+    if data[-CRC_TRAILER_SIZE:-CRC_TRAILER_SIZE + 1] == CRC_TRAILER:
+        return "json"
+    return "legacy"
+
+def msg_type_of(data):
+    # msg_type without decoding the message, None when it cannot be found
+    if data[:1] == bytes([BINARY_MAGIC]):
+        return msg_type_names.get(data[2]) if len(data) > 2 else None
+    if data[:1] == bytes([DELTA_MAGIC]):
+        return "data"
+    data = bytes(data)
+    start = data.find(b'"msg_type":"')
+    if start < 0:
+        return None
+    start += 12
+    return data[start:data.find(b'"', start)].decode("utf-8", "replace")
+
+def negotiate(formats, sensor_id=None):
+    for fmt in formats:
+        if fmt in FORMATS:
+            return fmt
+        if fmt in STATEFUL_FORMATS and sensor_id is not None and sensor_type(sensor_id) in payload_schemas:
+            return fmt
+    return "legacy"
+
+def dump(message, fmt="json"):
+    # delta sensors get everything but their readings in binary
+    if fmt == "binary" or fmt == "delta":
+        return binary_dump(message)
+    if fmt == "legacy":
+        return legacy_json_dump(message)
     return json_dump(message)
 
+def load(data):
+    if data[:1] == bytes([BINARY_MAGIC]):
+        return binary_load(data)
+    return json_load(data)
+
 def json_dump(message):
-    json_message = json.dumps(message, separators=(",", ":"), sort_keys=True)
+    message["header"]["crc"] = ""
+    json_message = json_encode(message)
     
-    checksum = CRC_CALCULATOR.checksum(json_message.encode("utf-8"))
+    checksum = zlib.crc32(json_message)
     
     message["header"]["crc"] = checksum
     
-    return json.dumps(message, separators=(",", ":"), sort_keys=True)
+    return f"{json_message.decode('utf-8')}|{checksum:08x}"
 
+def legacy_json_dump(message):
+    message["header"]["crc"] = ""
+    checksum = zlib.crc32(stdlib_encode(message))
+    
+    message["header"]["crc"] = checksum
+    
+    return stdlib_encode(message).decode("utf-8")
+
+def json_load(data):
+    if not isinstance(data, bytes):
+        data = bytes(data) # memoryview into a receive buffer
+    
+    if data[-CRC_TRAILER_SIZE:-CRC_TRAILER_SIZE + 1] != CRC_TRAILER:
+        return legacy_json_load(data)
+    
+    body = data[:-CRC_TRAILER_SIZE]
+    try:
+        crc = int(data[-CRC_TRAILER_SIZE + 1:], 16)
+        dictionary = json_decode(body)
+        dictionary["header"]["crc"] = crc
+    except (ValueError, TypeError, KeyError):
+        return None, False
+    
+    return dictionary, crc == zlib.crc32(body)
+
+def legacy_json_load(data):
+    try:
+        dictionary = json_decode(data)
+    except ValueError:
+        return None, False
+    
+    header = dictionary.get("header", {})
+    crc = header.get("crc")
+    
+    header["crc"] = ""
+    checksum = zlib.crc32(stdlib_encode(dictionary))
+    header["crc"] = crc
+    
+    return dictionary, crc == checksum
+
+def binary_dump(message):
+    header = message["header"]
+    data = header["data"]
+    sensor_id = header["sensor_id"].encode("utf-8")
+    kind = sensor_type(header["sensor_id"])
+    flags = 0
+    
+    if header["token"] is not None:
+        flags |= FLAG_TOKEN
+    if header.get("seq") is not None:
+        flags |= FLAG_SEQ
+    
+    schema = payload_schemas.get(kind)
+    if header["msg_type"] == "batch":
+        payload = binary_batch(data["readings"])
+    elif header["msg_type"] == "batch_ack":
+        payload = BINARY_BITMAP.pack(data["batch"])
+    elif schema is not None and data.keys() == set(schema[1]):
+        flags |= FLAG_SCHEMA
+        layout, fields, scales = schema
+        payload = layout.pack(*[round(data[field] * scale) for field, scale in zip(fields, scales)])
+    elif len(data) == 1:
+        key, value = next(iter(data.items()))
+        payload = BINARY_CONTROL.pack(control_keys.index(key), value)
+    else:
+        raise ValueError(f"no binary layout for {header['msg_type']} payload of {header['sensor_id']}")
+    
+    packet = BINARY_HEADER.pack(
+        BINARY_MAGIC,
+        BINARY_VERSION,
+        msg_type_map[header["msg_type"]],
+        sensors_map.get(kind, UNKNOWN_SENSOR),
+        battery_map[header["battery"]],
+        flags,
+        header["time_stamp"],
+        header["token"] or 0,
+        header.get("seq") or 0
+    ) + bytes([len(sensor_id)]) + sensor_id + payload
+    
+    checksum = zlib.crc32(packet)
+    header["crc"] = checksum
+    
+    return packet + BINARY_CRC.pack(checksum)
+
+def binary_load(data):
+    try:
+        magic, version, msg_type, kind, battery, flags, time_stamp, token, seq = BINARY_HEADER.unpack_from(data)
+        if version != BINARY_VERSION:
+            return None, False
+        
+        offset = BINARY_HEADER.size
+        length = data[offset]
+        sensor_id = bytes(data[offset + 1:offset + 1 + length]).decode("utf-8")
+        offset += 1 + length
+        
+        if msg_type == msg_type_map["batch"]:
+            payload, offset = binary_batch_load(data, offset)
+        elif msg_type == msg_type_map["batch_ack"]:
+            payload = {"batch": BINARY_BITMAP.unpack_from(data, offset)[0]}
+            offset += BINARY_BITMAP.size
+        elif flags & FLAG_SCHEMA:
+            layout, fields, scales = payload_schemas[sensors_names[kind]]
+            values = layout.unpack_from(data, offset)
+            payload = {field: value if scale == 1 else value / scale for field, value, scale in zip(fields, values, scales)}
+            offset += layout.size
+        else:
+            key, value = BINARY_CONTROL.unpack_from(data, offset)
+            payload = {control_keys[key]: value}
+            offset += BINARY_CONTROL.size
+        
+        crc, = BINARY_CRC.unpack_from(data, offset)
+        
+        dictionary = {
+            "header": {
+            "msg_type": msg_type_names[msg_type],
+            "time_stamp": time_stamp,
+            "sensor_id": sensor_id,
+            "battery": battery_names[battery],
+            "token": token if flags & FLAG_TOKEN else None,
+            "crc": crc,
+            "data": payload
+            }
+        }
+        if flags & FLAG_SEQ:
+            dictionary["header"]["seq"] = seq
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError):
+        return None, False
+    
+    return dictionary, crc == zlib.crc32(data[:offset])
+
+def binary_batch(readings):
+    parts = [bytes([len(readings)])]
+    
+    for entry in readings:
+        sensor_id = entry["sensor_id"].encode("utf-8")
+        kind = sensor_type(entry["sensor_id"])
+        layout, fields, scales = payload_schemas[kind]
+        data = entry["data"]
+        parts.append(BATCH_ENTRY.pack(sensors_map[kind], battery_map[entry["battery"]], entry["time_stamp"], entry["token"] or 0, entry["seq"] or 0))
+        parts.append(bytes([len(sensor_id)]) + sensor_id)
+        parts.append(layout.pack(*[round(data[field] * scale) for field, scale in zip(fields, scales)]))
+    
+    return b"".join(parts)
+
+def binary_batch_load(data, offset):
+    readings = []
+    count = data[offset]
+    offset += 1
+    
+    for _ in range(count):
+        kind, battery, time_stamp, token, seq = BATCH_ENTRY.unpack_from(data, offset)
+        offset += BATCH_ENTRY.size
+        length = data[offset]
+        sensor_id = bytes(data[offset + 1:offset + 1 + length]).decode("utf-8")
+        offset += 1 + length
+        layout, fields, scales = payload_schemas[sensors_names[kind]]
+        values = layout.unpack_from(data, offset)
+        offset += layout.size
+        readings.append({
+            "sensor_id": sensor_id,
+            "token": token,
+            "seq": seq,
+            "time_stamp": time_stamp,
+            "battery": battery_names[battery],
+            "data": {field: value if scale == 1 else value / scale for field, value, scale in zip(fields, values, scales)}
+        })
+    
+    return {"readings": readings}, offset
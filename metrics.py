@@ -0,0 +1,170 @@
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = 24             # power of two microsecond buckets, the last one is open ended
+SNAPSHOT_INTERVAL = 10   # seconds between snapshot files
+
+
+class Histogram:
+
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self) -> None:
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        # bucket i holds values below 2**i microseconds
+        self.counts[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return 1 << bucket
+        return 1 << (BUCKETS - 1)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count * 1e6 if self.count else None,
+            "p50_us": self.percentile(0.5),
+            "p99_us": self.percentile(0.99),
+            "buckets": {f"<{1 << bucket}us": count for bucket, count in enumerate(self.counts) if count},
+        }
+
+
+class Metrics:
+    # plain dict increments under the GIL, cheap enough for every datagram;
+    # threads racing on one counter can lose an increment, which is tolerated
+
+    def __init__(self, path=None) -> None:
+        self.path = path
+        self.started = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+        self.sockets = []
+        self.previous = ({}, self.started)   # counters at the last tick, for rates
+        self.written_at = self.started
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def watch(self, sock):
+        # report the kernel's receive queue drops for this socket
+        self.sockets.append(sock)
+
+    def unwatch(self, sock):
+        if sock in self.sockets:
+            self.sockets.remove(sock)
+
+    def snapshot(self):
+        now = time.monotonic()
+        counters = dict(self.counters)
+        previous, previous_at = self.previous
+        elapsed = now - previous_at
+
+        # a socket that cannot be looked up (closed, not Linux) is left out
+        drops = [drops for drops in map(receive_drops, self.sockets) if drops is not None]
+        if drops:
+            counters["receive_drops"] = sum(drops)
+
+        return {
+            "time": time.time(),
+            "uptime": now - self.started,
+            "counters": counters,
+            "rates": {name: (value - previous.get(name, 0)) / elapsed for name, value in counters.items()} if elapsed > 0 else {},
+            "histograms": {name: histogram.summary() for name, histogram in list(self.histograms.items())},
+        }
+
+    def tick(self):
+        now = time.monotonic()
+        if self.path is None or now - self.written_at < SNAPSHOT_INTERVAL:
+            return
+        snapshot = self.snapshot()
+        self.previous = (snapshot["counters"], now)
+        self.written_at = now
+        self.write(self.path, snapshot)
+
+    def write(self, path, snapshot=None):
+        # replace the file in one rename so readers never see half a snapshot
+        snapshot = snapshot or self.snapshot()
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def serve(self, port, host="127.0.0.1"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot(), indent=2).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+
+class TimedLock:
+    # threading.Lock that records how long callers wait for it and hold it
+
+    def __init__(self, metrics, name="lock") -> None:
+        self.lock = threading.Lock()
+        self.wait = metrics.histogram(f"{name}_wait")
+        self.hold = metrics.histogram(f"{name}_hold")
+        self.acquired = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        self.wait.observe(self.acquired - start)
+        return self
+
+    def __exit__(self, *exc):
+        self.hold.observe(time.perf_counter() - self.acquired)
+        self.lock.release()
+
+
+def receive_drops(sock):
+    # drops column of /proc/net/udp for this socket's inode, None off Linux
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        table = "/proc/net/udp6" if sock.family == socket.AF_INET6 else "/proc/net/udp"
+        with open(table, encoding="ascii") as f:
+            for line in f.readlines()[1:]:
+                columns = line.split()
+                if columns[9] == inode:
+                    return int(columns[-1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return None
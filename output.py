@@ -0,0 +1,115 @@
+import json
+import queue
+import threading
+
+BATCH = 256         # records written per sink call
+FLUSH_INTERVAL = 10 # seconds without records before sinks are flushed
+QUEUE_LIMIT = 8192  # records waiting for the sinks before new ones are dropped
+
+
+class ConsoleSink:
+
+    def write(self, batch):
+        lines = []
+        for sensor_id, time_stamp, battery, data in batch:
+            if battery == "high":
+                lines.append(f" {time_stamp} - {sensor_id}  ")
+            else:
+                lines.append(f" \033[31m{time_stamp} - WARNING: LOW BATTERY {sensor_id}  \033[0m")
+            for key, value in data.items():
+                lines.append(f" {key}: {value},")
+            lines.append("\n ")
+        print("\n".join(lines))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink:
+
+    def __init__(self, path) -> None:
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, batch):
+        self.file.write("".join(self.format(record) for record in batch))
+
+    def format(self, record):
+        sensor_id, time_stamp, battery, data = record
+        values = " ".join(f"{key}={value}" for key, value in data.items())
+        return f"{time_stamp} {sensor_id} battery={battery} {values}\n"
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlSink(FileSink):
+
+    def format(self, record):
+        sensor_id, time_stamp, battery, data = record
+        return json.dumps({"sensor_id": sensor_id, "time_stamp": time_stamp, "battery": battery, "data": data}, separators=(",", ":")) + "\n"
+
+
+class Pipeline:
+
+    def __init__(self, sinks=None, batch=BATCH, limit=QUEUE_LIMIT) -> None:
+        self.sinks = list(sinks) if sinks is not None else [ConsoleSink()]
+        self.batch = batch
+        self.limit = limit
+        self.queue = queue.SimpleQueue()
+
+    def push(self, sensor_id, time_stamp, battery, data):
+        # False when the sinks are too far behind and the record is dropped;
+        # the receiving thread is the only producer, so qsize() is exact enough
+        if self.queue.qsize() >= self.limit:
+            return False
+        self.queue.put((sensor_id, time_stamp, battery, data))
+        return True
+
+    def add(self, sink):
+        self.sinks = self.sinks + [sink]
+
+    def drain(self, first=None):
+        batch = [] if first is None else [first]
+        try:
+            while len(batch) < self.batch:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def write(self, batch):
+        for sink in self.sinks:
+            sink.write(batch)
+
+    def flush(self):
+        # write whatever is queued now, for callers that poll instead of run()
+        batch = self.drain()
+        while batch:
+            self.write(batch)
+            batch = self.drain()
+        for sink in self.sinks:
+            sink.flush()
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                for sink in self.sinks:
+                    sink.flush()
+                continue
+            self.write(self.drain(record))
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
@@ -0,0 +1,120 @@
+from array import array
+from itertools import compress
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import messages
+
+
+class Table:
+    # readings of one sensor type as columns: "time", "sensor_id" and one per
+    # field. Columns are numpy arrays when numpy is installed, otherwise
+    # array.array for numbers and a list for sensor_id, so filters and
+    # aggregations run per column rather than per reading
+
+    def __init__(self, fields, columns) -> None:
+        self.fields = tuple(fields)
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    def where(self, start=None, end=None, **bounds):
+        # readings with start <= time <= end and low <= field <= high for
+        # every field=(low, high); None leaves that side open
+        if start is not None or end is not None:
+            bounds["time"] = (start, end)
+
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            for name, (low, high) in bounds.items():
+                if low is not None:
+                    mask &= self.columns[name] >= low
+                if high is not None:
+                    mask &= self.columns[name] <= high
+            return Table(self.fields, {name: column[mask] for name, column in self.columns.items()})
+
+        mask = [True] * len(self)
+        for name, (low, high) in bounds.items():
+            column = self.columns[name]
+            if low is not None:
+                mask = [keep and value >= low for keep, value in zip(mask, column)]
+            if high is not None:
+                mask = [keep and value <= high for keep, value in zip(mask, column)]
+        return Table(self.fields, {name: select(column, mask) for name, column in self.columns.items()})
+
+    def aggregate(self, fields=None):
+        # {field: {count, sum, mean, min, max}} over every reading in the table
+        result = {}
+
+        for field in fields or self.fields:
+            column = self.columns[field]
+            if not len(column):
+                continue
+            if numpy is not None:
+                total, low, high = column.sum().item(), column.min().item(), column.max().item()
+            else:
+                total, low, high = sum(column), min(column), max(column)
+            result[field] = {"count": len(column), "sum": total, "mean": total / len(column), "min": low, "max": high}
+
+        return result
+
+    def sensors(self):
+        # distinct sensor ids, e.g. the ones left after an alert threshold
+        if numpy is not None:
+            return numpy.unique(self.columns["sensor_id"]).tolist()
+        return sorted(set(self.columns["sensor_id"]))
+
+    def records(self):
+        # numpy structured array with one row per reading
+        if numpy is None:
+            raise RuntimeError("numpy is not installed, use Table.columns")
+
+        names = ("time", "sensor_id") + self.fields
+        records = numpy.empty(len(self), dtype=[(name, self.columns[name].dtype) for name in names])
+        for name in names:
+            records[name] = self.columns[name]
+        return records
+
+
+def table(registry, kind, start=None, end=None):
+    # every reading of sensors of type `kind` between start and end, sensor
+    # by sensor and oldest first within a sensor. Off the receiving thread a
+    # reading appended during the copy may be missing or half written
+    buffers = [state for state in registry if messages.sensor_type(state.sensor_id) == kind and state.readings is not None]
+    fields = buffers[0].readings.fields if buffers else messages.payload_schemas.get(kind, (None, ()))[1]
+    typecodes = {field: "q" for field in fields}
+    parts = []
+
+    for state in buffers:
+        if state.readings.fields != fields:
+            continue  # a schemaless sensor with other fields than the first one
+        columns = state.readings.arrays(start, end)
+        typecodes.update((field, column.typecode) for field, column in columns.items())
+        parts.append((state.sensor_id, columns))
+
+    columns = {"time": array("q")}
+    columns.update((field, array(typecodes[field])) for field in fields)
+    ids = []
+    for sensor_id, part in parts:
+        for name, column in part.items():
+            columns[name].extend(column)
+        ids.append((sensor_id, len(part["time"])))
+
+    if numpy is not None:
+        columns = {name: numpy.frombuffer(column, dtype=column.typecode) if len(column) else numpy.empty(0, dtype=column.typecode)
+                   for name, column in columns.items()}
+        columns["sensor_id"] = numpy.repeat(numpy.array([sensor_id for sensor_id, n in ids], dtype=str), [n for sensor_id, n in ids])
+    else:
+        columns["sensor_id"] = [sensor_id for sensor_id, n in ids for _ in range(n)]
+
+    return Table(fields, columns)
+
+
+def select(column, mask):
+    if isinstance(column, array):
+        return array(column.typecode, compress(column, mask))
+    return list(compress(column, mask))
@@ -0,0 +1,134 @@
+import heapq
+import time
+
+TIMEOUT = 15         # seconds of silence before a sensor is pinged
+PING_INTERVAL = 5    # seconds between activity pings
+PING_ATTEMPTS = 10   # pings sent before the sensor is given up on
+SEQ_WINDOW = 64      # seqs below the highest stored one that are still told apart
+
+
+class SensorState:
+
+    __slots__ = ("sensor_id", "token", "battery", "format", "active", "respond", "withheld",
+                 "last_seen", "deadline", "pings", "queued", "readings", "seq_top", "seq_seen",
+                 "address", "templates")
+
+    def __init__(self, sensor_id, token, fmt, time_stamp, deadline) -> None:
+        self.sensor_id = sensor_id
+        self.token = token
+        self.battery = "high"
+        self.format = fmt
+        self.active = 1
+        self.respond = 1     # 0 while the menu withholds ACKs
+        self.withheld = 0    # ACKs skipped since respond was cleared
+        self.last_seen = time_stamp  # sensor clock, for display
+        self.deadline = deadline     # monotonic time of the next liveness check or ping
+        self.pings = 0               # activity pings sent since the sensor went quiet
+        self.queued = False  # has an entry in Registry.deadlines
+        self.readings = None # storage.RingBuffer, created with the first reading
+        self.seq_top = 0     # highest seq stored under this token
+        self.seq_seen = 0    # bit i set when seq_top - i was stored
+        self.address = None  # last source address seen under this token, replies go there
+        self.templates = {}  # messages.Template per control reply, dropped with the token
+
+
+class Registry:
+
+    # the deadline heap is the only timer for liveness and ping retries, so a
+    # mass outage costs heap operations rather than threads
+
+    def __init__(self, timeout=TIMEOUT, clock=time.monotonic) -> None:
+        self.timeout = timeout
+        self.clock = clock
+        self.sensors = {}
+        self.deadlines = []  # heap of (deadline, sensor_id), at most one entry per sensor
+
+    def __len__(self):
+        return len(self.sensors)
+
+    def __iter__(self):
+        return iter(list(self.sensors.values()))
+
+    def __contains__(self, sensor_id):
+        return sensor_id in self.sensors
+
+    def get(self, sensor_id):
+        return self.sensors.get(sensor_id)
+
+    def snapshot(self):
+        # immutable view for threads other than the writer
+        return tuple((state.sensor_id, state.token, state.battery, state.format, state.active, state.last_seen)
+                     for state in list(self.sensors.values()))
+
+    def register(self, sensor_id, token, fmt, time_stamp):
+        state = SensorState(sensor_id, token, fmt, time_stamp, self.clock() + self.timeout)
+        old = self.sensors.get(sensor_id)
+        self.sensors[sensor_id] = state
+
+        if old is not None and old.queued:
+            state.queued = True  # the old heap entry now stands for the new state
+        else:
+            self._schedule(state)
+
+        return state
+
+    def touch(self, state, time_stamp):
+        if time_stamp > state.last_seen:
+            state.last_seen = time_stamp
+        state.active = 1
+        state.pings = 0
+        state.deadline = self.clock() + self.timeout
+        if not state.queued:
+            self._schedule(state)
+
+    def fresh(self, state, seq):
+        # anti-replay window: True, and the seq is marked, unless it was
+        # already stored or is too old to tell; readings without seq pass
+        if seq is None:
+            return True
+
+        if seq > state.seq_top:
+            shift = seq - state.seq_top
+            state.seq_seen = (state.seq_seen << shift | 1) & ((1 << SEQ_WINDOW) - 1) if shift < SEQ_WINDOW else 1
+            state.seq_top = seq
+            return True
+
+        if state.seq_top - seq >= SEQ_WINDOW:
+            return False
+        bit = 1 << (state.seq_top - seq)
+        if state.seq_seen & bit:
+            return False
+        state.seq_seen |= bit
+        return True
+
+    def due(self, now=None):
+        # sensors to ping now; entries are refreshed lazily: a sensor that was
+        # touched since it was queued is pushed back with its new deadline
+        now = self.clock() if now is None else now
+        due = []
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, sensor_id = heapq.heappop(self.deadlines)
+            state = self.sensors.get(sensor_id)
+
+            if state is None:
+                continue
+
+            state.queued = False
+
+            if state.deadline > now:
+                self._schedule(state)
+            elif state.pings < PING_ATTEMPTS:
+                state.active = 0
+                state.pings += 1
+                state.deadline = now + PING_INTERVAL
+                self._schedule(state)
+                due.append(state)
+            else:
+                state.active = 0  # given up, the next message schedules it again
+
+        return due
+
+    def _schedule(self, state):
+        state.queued = True
+        heapq.heappush(self.deadlines, (state.deadline, state.sensor_id))
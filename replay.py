@@ -0,0 +1,92 @@
+import argparse
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import time
+
+import capture
+import output
+import server
+
+
+class ReplayServer:
+    # stands in for server.Server: replies are counted, nothing is sent
+
+    def __init__(self) -> None:
+        self.capture = None
+        self.replies = 0
+        self.reply_bytes = 0
+
+    def send_response(self, data, client):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.replies += 1
+        self.reply_bytes += len(data)
+
+
+def replay(path, speed=None, limit=None):
+    # feed a capture through process_message; speed None replays as fast as
+    # possible, 1.0 at the captured pace, 2.0 twice as fast
+    target = ReplayServer()
+    datagrams = 0
+    first = None
+    start = time.perf_counter()
+
+    for time_us, client, data in capture.read(path):
+        if limit is not None and datagrams >= limit:
+            break
+
+        if speed is not None:
+            first = time_us if first is None else first
+            delay = (time_us - first) / 1e6 / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        server.process_message(data, target, client)
+        datagrams += 1
+
+    elapsed = time.perf_counter() - start
+    return {
+        "datagrams": datagrams,
+        "elapsed": elapsed,
+        "rate": datagrams / elapsed if elapsed else 0.0,
+        "replies": target.replies,
+        "reply_bytes": target.reply_bytes,
+        "counters": dict(server.stats.counters),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a datagram capture through the server handlers")
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, help="multiple of the captured pace, default as fast as possible")
+    parser.add_argument("--limit", type=int, help="stop after this many datagrams")
+    parser.add_argument("--print", action="store_true", help="print readings and server messages like the live server")
+    parser.add_argument("--profile", type=int, default=0, metavar="N", help="show the N most expensive functions")
+    options = parser.parse_args(argv)
+
+    server.outputs = output.Pipeline() if options.print else output.Pipeline([])
+    if options.print:
+        server.outputs.start()
+
+    with contextlib.ExitStack() as stack:
+        if not options.print:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        profile = cProfile.Profile() if options.profile else None
+        if profile is not None:
+            result = profile.runcall(replay, options.path, options.speed, options.limit)
+        else:
+            result = replay(options.path, options.speed, options.limit)
+
+    if profile is not None:
+        pstats.Stats(profile).sort_stats("tottime").print_stats(options.profile)
+
+    server.outputs.close()
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
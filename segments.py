@@ -0,0 +1,219 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+import messages
+
+DIRECTORY = "archive"
+SEGMENT_RECORDS = 1 << 16   # records per segment file before rolling over
+INDEX_STRIDE = 256          # records per time index block
+FSYNC_RECORDS = 512         # fsync after this many unsynced records ...
+FSYNC_INTERVAL = 5.0        # ... or after this many seconds
+
+RECORD_HEADER = struct.Struct("<qI")  # time_stamp, sensor number
+INDEX_ENTRY = struct.Struct("<qq")    # min and max time_stamp of one block
+
+
+class Segment:
+
+    def __init__(self, path, record) -> None:
+        self.path = path
+        self.record = record
+        self.index = []     # [min, max] time_stamp per INDEX_STRIDE block
+        self.count = 0
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, "ab")
+        size = self.file.tell()
+        if size % self.record.size:  # torn record from a crash
+            self.file.truncate(size - size % self.record.size)
+        self.count = self.file.tell() // self.record.size
+
+    def load_index(self):
+        path = self.path + ".idx"
+        self.count = os.path.getsize(self.path) // self.record.size
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.index = [list(entry) for entry in INDEX_ENTRY.iter_unpack(f.read())]
+            if len(self.index) == -(-self.count // INDEX_STRIDE):
+                return
+
+        self.index = []
+        for number, (time_stamp,) in enumerate(self.scan([(0, self.count)], times_only=True)):
+            self.add(time_stamp, number)
+
+    def add(self, time_stamp, number):
+        if number % INDEX_STRIDE == 0:
+            self.index.append([time_stamp, time_stamp])
+        else:
+            block = self.index[-1]
+            block[0] = min(block[0], time_stamp)
+            block[1] = max(block[1], time_stamp)
+
+    def seal(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        with open(self.path + ".idx", "wb") as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in self.index))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def scan(self, ranges, times_only=False):
+        # ranges of record numbers, read through one mmap of the segment
+        if not self.count:
+            return
+        with open(self.path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                size = self.record.size
+                for first, stop in ranges:
+                    for offset in range(first * size, stop * size, size):
+                        if times_only:
+                            yield struct.unpack_from("<q", view, offset)
+                        else:
+                            yield self.record.unpack_from(view, offset)
+
+
+def blocks(index, count, start, end):
+    # record ranges of the index blocks overlapping [start, end]
+    for block, (low, high) in enumerate(index):
+        if high >= start and low <= end:
+            first = block * INDEX_STRIDE
+            yield first, min(first + INDEX_STRIDE, count)
+
+
+class SegmentStore:
+
+    def __init__(self, directory=DIRECTORY, segment_records=SEGMENT_RECORDS, lock=None) -> None:
+        self.directory = directory
+        self.segment_records = segment_records
+        self.lock = lock or threading.Lock()
+        self.segments = {}      # sensor type -> [Segment], the last one is open for appends
+        self.numbers = {}       # sensor_id -> sensor number
+        self.names = []
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        self.ids = open(os.path.join(directory, "sensors.txt"), "a+", encoding="utf-8")
+        self.ids.seek(0)
+        for line in self.ids.read().splitlines():
+            self.numbers[line] = len(self.names)
+            self.names.append(line)
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".seg"):
+                kind = name.rsplit("-", 1)[0]
+                if kind in messages.payload_schemas:
+                    segment = Segment(os.path.join(directory, name), self.layout(kind))
+                    segment.load_index()
+                    self.segments.setdefault(kind, []).append(segment)
+
+        for segments in self.segments.values():
+            segments[-1].open()
+
+    def layout(self, kind):
+        return struct.Struct(RECORD_HEADER.format + messages.payload_schemas[kind][0].format[1:])
+
+    def append(self, sensor_id, time_stamp, data):
+        kind = messages.sensor_type(sensor_id)
+        schema = messages.payload_schemas.get(kind)
+
+        if schema is None:
+            return  # no fixed record layout for this sensor type
+
+        layout, fields, scales = schema
+        values = [round(data.get(field, 0) * scale) for field, scale in zip(fields, scales)]
+
+        with self.lock:
+            number = self.numbers.get(sensor_id)
+            if number is None:
+                number = self.numbers[sensor_id] = len(self.names)
+                self.names.append(sensor_id)
+                self.ids.write(sensor_id + "\n")
+                self.ids.flush()
+
+            segment = self.writer(kind)
+            try:
+                record = segment.record.pack(time_stamp, number, *values)
+            except struct.error:
+                return  # reading outside the schema's range
+            segment.file.write(record)
+            segment.add(time_stamp, segment.count)
+            segment.count += 1
+
+            self.unsynced += 1
+            if self.unsynced >= FSYNC_RECORDS or time.monotonic() - self.synced_at >= FSYNC_INTERVAL:
+                self._sync()
+
+    def writer(self, kind):
+        segments = self.segments.setdefault(kind, [])
+
+        if not segments or segments[-1].count >= self.segment_records:
+            if segments:
+                segments[-1].file.flush()
+                os.fsync(segments[-1].file.fileno())
+                segments[-1].seal()
+            segment = Segment(os.path.join(self.directory, f"{kind}-{len(segments):06d}.seg"), self.layout(kind))
+            segment.open()
+            segments.append(segment)
+
+        return segments[-1]
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def tick(self):
+        # sync records left behind when traffic stops before a batch fills
+        if self.unsynced and time.monotonic() - self.synced_at >= FSYNC_INTERVAL:
+            self.sync()
+
+    def _sync(self):
+        for segments in self.segments.values():
+            if segments[-1].file is not None:
+                segments[-1].file.flush()
+                os.fsync(segments[-1].file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def query(self, kind, start=0, end=None, sensor_id=None):
+        # (time_stamp, sensor_id, data) tuples in write order
+        return list(self.replay(kind, start, end, sensor_id))
+
+    def replay(self, kind, start=0, end=None, sensor_id=None):
+        layout, fields, scales = messages.payload_schemas[kind]
+        end = end if end is not None else 1 << 62
+        number = self.numbers.get(sensor_id) if sensor_id is not None else None
+
+        if sensor_id is not None and number is None:
+            return
+
+        # count and index are copied under the lock: records appended while
+        # the generator runs may still sit in the writer's file buffer
+        with self.lock:
+            snapshot = []
+            for segment in self.segments.get(kind, ()):
+                if segment.file is not None:
+                    segment.file.flush()
+                snapshot.append((segment, segment.count, [list(block) for block in segment.index]))
+
+        for segment, count, index in snapshot:
+            if not count:
+                continue
+            for time_stamp, sensor, *values in segment.scan(list(blocks(index, count, start, end))):
+                if start <= time_stamp <= end and (number is None or sensor == number):
+                    yield time_stamp, self.names[sensor], {field: value if scale == 1 else value / scale for field, value, scale in zip(fields, values, scales)}
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            for segments in self.segments.values():
+                if segments[-1].file is not None:
+                    segments[-1].file.close()
+                    segments[-1].file = None
+            self.ids.close()
@@ -1,42 +1,197 @@
-import json
+import aggregate
+import asyncio
+import capture
+import collections
+import delta
+import math
+import multiprocessing
+import os
+import signal
 import socket
-import crc
+import struct
+import sys
 import threading
 import time
 import messages
+import metrics
+import output
+import query
+import registry
+import segments
+import storage
 
-CRC_CALCULATOR = crc.Calculator(crc.Crc32.CRC32)
+stats = metrics.Metrics()
 
-LOCK = threading.Lock()
+BUFFER_SIZE = 2048 # must hold a full batch datagram (messages.MAX_DATAGRAM)
+RECV_BATCH = 64    # datagrams drained per wakeup into preallocated buffers
 
-sensors = {
-    "ThermoNode": None,
-    "WindSense" : None,
-    "RainDetect": None,
-    "AirQualityBox": None
-}
+RECEIVE_BUFFER = 4 << 20 # SO_RCVBUF requested, the kernel caps it at net.core.rmem_max
+INGRESS_LIMIT = 8192     # bulk datagrams queued for handlers before new ones are shed
+PUMP_BUDGET = 256        # bulk datagrams handled per wakeup before the socket is read again
+READ_BUDGET = 1024       # datagrams read per wakeup; reading outpaces handling, so an
+                         # overload fills the backlog and is shed instead of dropped by the kernel
+SLOW_DOWN = 2            # seconds a shed sender is asked to back off
+URGENT = ("registration", "activity") # handled ahead of data, batches and retransmits
+
+# sensor state has a single writer: the thread or event loop that receives
+# datagrams also runs the liveness checks, so handlers never wait on a lock.
+# Other threads only read registry snapshots or store single attributes.
+sensors = registry.Registry()
+
+archive = None # segments.SegmentStore once the server is listening
+
+outputs = output.Pipeline()
+
+aggregates = aggregate.Aggregator() # per-minute and per-hour statistics per sensor
+
+deltas = delta.Decoder() # delta format tokens and the acked readings their deltas refer to
 
 token_counter = 0
-unix_time = 0
+token_base = int(time.time() * 1000) # server clock at start, the sensor's time stamp would let tokens repeat
+
+# SO_REUSEPORT workers: tokens are allocated as (token_base + counter) * WORKERS + WORKER_ID
+# so every worker hands out a disjoint set and token % WORKERS names the owner
+WORKERS = 1
+WORKER_ID = 0
 
 class Server:
     
-    def __init__(self, server_ip, server_port) -> None:
+    def __init__(self, server_ip, server_port, reuse_port=False, receive_buffer=RECEIVE_BUFFER) -> None:
         self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
         
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if receive_buffer:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.receive_buffer = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        
         self.sock.bind((server_ip, server_port)) 
+        
+        self.buffers = [bytearray(BUFFER_SIZE) for _ in range(RECV_BATCH)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.outbox = []     # replies queued while pump() runs, sent by flush()
+        self.pumping = None  # thread running pump(), its replies are queued
+        self.capture = None  # capture.Capture recording every received datagram
+        self.backlog = collections.deque() # bulk (data, client) waiting for handlers
+        self.slowed = {}     # client -> monotonic time its last slow_down expires
+        
+        stats.watch(self.sock)
 
-    def receive(self):
-        data = None
-        while data == None:
-            data, self.client= self.sock.recvfrom(1024) #buffer size is 1024 bytes
+    def receive_many(self, block=True):
+        # every ready datagram, as views into the preallocated buffers that
+        # stay valid until the next call; only the first recv may block
+        received = []
+        flags = 0 if block else socket.MSG_DONTWAIT
+        
+        for view in self.views:
+            try:
+                size, client = self.sock.recvfrom_into(view, 0, flags)
+            except BlockingIOError:
+                break
+            except ConnectionRefusedError:
+                continue # ICMP port unreachable from an earlier reply
+            received.append((view[:size], client))
+            flags = socket.MSG_DONTWAIT
+        
+        if self.capture is not None:
+            now = time.time_ns() // 1000
+            for data, client in received:
+                self.capture.write(now, data, client)
         
-        return data, self.client
+        return received
 
-    def send_response(self, data):
-        self.sock.sendto(data.encode("utf-8"),self.client)
+    def set_receive_timeout(self, seconds):
+        # kernel side timeout on the blocking socket, unlike settimeout() it
+        # leaves the MSG_DONTWAIT receives in receive_many() without a poll
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", int(seconds), int(seconds % 1 * 1e6)))
+
+    def pump(self, block=True):
+        # the socket is drained (up to READ_BUDGET) before any handler runs:
+        # registration and activity are handled at once, bulk traffic goes
+        # through the bounded backlog and is shed when the backlog is full
+        urgent = []
+        count = 0
+        block = block and not self.backlog
+        
+        while count < READ_BUDGET:
+            received = self.receive_many(block)
+            block = False
+            count += len(received)
+            
+            # copies, the next receive_many() reuses the buffers
+            for data, client in received:
+                if messages.msg_type_of(data) in URGENT:
+                    urgent.append((bytes(data), client))
+                elif len(self.backlog) < INGRESS_LIMIT:
+                    self.backlog.append((bytes(data), client))
+                else:
+                    self.shed(data, client)
+            
+            if len(received) < RECV_BATCH:
+                break # socket empty
+        
+        self.pumping = threading.get_ident()
+        handler = stats.histogram("handler")
+        try:
+            for data, client in urgent:
+                self.handle(data, client, handler)
+            
+            for _ in range(min(PUMP_BUDGET, len(self.backlog))):
+                data, client = self.backlog.popleft()
+                self.handle(data, client, handler)
+        finally:
+            self.pumping = None
+            self.flush()
+        
+        return count
+
+    def handle(self, data, client, handler):
+        # one malformed datagram must not take the receive loop down with it
+        start = time.perf_counter()
+        try:
+            process_message(data, self, client)
+        except Exception as error:
+            stats.count("handler_errors")
+            print(f" \033[31m ERROR: datagram from {client} failed: {error!r} \033[0m")
+        handler.observe(time.perf_counter() - start)
+
+    def shed(self, data, client):
+        stats.count("shed")
+        now = time.monotonic()
+        
+        if self.slowed.get(client, 0) > now:
+            return
+        if len(self.slowed) >= INGRESS_LIMIT:
+            self.slowed.clear()
+        self.slowed[client] = now + SLOW_DOWN
+        
+        msg = messages.sensor_message("Server", None, {"slow_down": SLOW_DOWN}, "high", "slow_down", 0, messages.format_of(data))
+        self.send_response(msg, client)
+        stats.count("slow_down_sent")
+
+    def send_response(self, data, client):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.pumping == threading.get_ident():
+            self.outbox.append((data, client))
+            return
+        try:
+            self.sock.sendto(data,client)
+        except BlockingIOError:
+            pass # send buffer full, the sensor retransmits
+
+    def flush(self):
+        outbox = self.outbox
+        self.outbox = []
+        
+        for data, client in outbox:
+            try:
+                self.sock.sendto(data, client)
+            except BlockingIOError:
+                pass
 
     def quit(self):
+        stats.unwatch(self.sock)
         self.sock.close() # correctly closing socket
         print("Server closed")
 
@@ -47,6 +202,13 @@ def menu():
     print(" 1: Set IP and port (configure) ")
     print(" 2: listen ")
     print(" 3: do not confirm message ")
+    print(" 4: listen (asyncio) ")
+    print(" 5: log readings to file ")
+    print(" 6: listen (worker processes) ")
+    print(" 7: metrics endpoint ")
+    print(" 8: show aggregates ")
+    print(" 9: capture datagrams to file ")
+    print(" 10: query readings by sensor type ")
     print(" q: quit ")
     print(" ------------")
     
@@ -56,153 +218,207 @@ def menu():
 
     
        
-def process_message(data, server):
-    dictionary = data.decode("utf-8")
-    dictionary = json.loads(dictionary)
+def process_message(data, server, client):
+    if delta.is_delta(data):
+        dictionary, valid = deltas.load(data)
+    else:
+        dictionary, valid = messages.load(data)
+    
+    if dictionary is None:
+        stats.count("undecodable")
+        return
     
     header = dictionary.get("header", {})
     msg_type = header.get("msg_type")
-    crc = header.get("crc")
-    
-    token = header.get("token")  
-    sensor_id = header.get("sensor_id")
-    battery = header.get("battery")
+    # msg_type comes from the datagram, only known ones get their own counter
+    known = isinstance(msg_type, str) and msg_type in messages.msg_type_map
+    stats.count(f"packets_{msg_type}" if known else "packets_unknown")
     
-    data = data.decode("utf-8")
-    data = json.loads(data)
-    data["header"]["crc"] = ""
-    
-    data = json.dumps(data, separators=(",", ":"), sort_keys=True).encode("utf-8")
-    
-    checksum = CRC_CALCULATOR.checksum(data)
-    
-    
-    if crc != checksum:
-        handle_corrupted(dictionary, server, 0)
+    if not valid:
+        stats.count("crc_failures")
+        handle_corrupted(dictionary, server, 0, client)
     
     elif msg_type == "registration":
-        handle_registration(dictionary, server)
+        handle_registration(dictionary, server, client)
         
     elif msg_type == "data":
-        handle_data(dictionary, server)
+        handle_data(dictionary, server, client)
         
     elif msg_type == "error":
-        handle_corrupted(dictionary, server, 1)
+        handle_corrupted(dictionary, server, 1, client)
     
     elif msg_type == "activity":
-        handle_reconnect(dictionary, server)
+        handle_reconnect(dictionary, server, client)
+    
+    elif msg_type == "batch":
+        handle_batch(dictionary, server, client, messages.format_of(data))
         
 
-def handle_reconnect(dictionary, server):
+def handle_reconnect(dictionary, server, client):
     header = dictionary["header"]
     sensor = header["sensor_id"]
-    handle_data(dictionary, server)
+    handle_data(dictionary, server, client)
+    stats.count("reconnects")
     print(f" \033[31m INFO: {sensor} RECONNECTED!  \033[0m")
     
        
         
+def ping(server, state):
+    sensor_id = state.sensor_id
+    msg = messages.control_message(sensor_id, state.token, state.battery, "activity", 0, state.format, None, state.templates)
+    server.send_response(msg, state.address)
+    stats.count("activity_pings")
+    print(f" \033[31m WARNING: {sensor_id} DISCONNECTED! \n \033[0m")
+
 def activity_check(server):
+    # runs on the receiving thread or event loop, the registry's only writer
+    for state in sensors.due():
+        ping(server, state)
+    
+    if archive is not None:
+        archive.tick()
+    if server.capture is not None:
+        server.capture.flush()
+    stats.tick()
+
+async def activity_check_task(server):
     
     while True:
-        
-        with LOCK:
-            for sensor in sensors:
-                dictionary = sensors[sensor]
-            
-                if dictionary == None:
-                    continue
-            
-                data = dictionary["data"]
-                last_message = data[len(data)-1]
-                header = last_message["header"]
-                sensor_id = header["sensor_id"]
-                battery = header["battery"]
-                token = header["token"]
-                time_stamp = header["time_stamp"]
-                active = dictionary["active"]
-            
-                if unix_time - time_stamp > 15 and active:
-                    
-                    threading.Thread(target=reconnect, args=(sensor_id, token, battery, 0, server,), daemon=True).start()
-                
-        time.sleep(1)
-    
-            
-def reconnect(sensor_id, token, battery, time_stamp, server):
-    time_count = int(time.time())
-    send_count = 0
-    flag = 1
-    
-    with LOCK:
-        sensors[sensor_id]["active"] = 0
-        
-    while(not sensors[sensor_id]["active"]) and send_count < 10:
-        if unix_time - time_count > 1 and flag:
-            msg = messages.sensor_message(sensor_id, token, {"activity":1}, battery, "activity", 0)
-            server.send_response(msg)  
-            print(f" \033[31m WARNING: {sensor_id} DISCONNECTED! \n \033[0m")  
-            flag = 0
-            time_count = unix_time
-            send_count += 1
-        if unix_time - time_count >= 5 and not flag:
-            msg = messages.sensor_message(sensor_id, token, {"activity":1}, battery, "activity", 0)
-            server.send_response(msg)
-            print(f" \033[31m WARNING: {sensor_id} DISCONNECTED! \n \033[0m")
-            time_count = unix_time
-        time.sleep(5)   
+        activity_check(server)
+        await asyncio.sleep(1)
               
         
-def handle_registration(dictionary, server):
+def handle_registration(dictionary, server, client):
     global token_counter
     
-    with LOCK:
-        timestamp = dictionary["header"]["time_stamp"]
-        token = int(timestamp * 1000) + token_counter
-        
-        token_counter += 1
-        
-        sensor = dictionary["header"]["sensor_id"]
-        sensors[sensor] = {"token":token, "battery":"high", "data":[dictionary], "log":[False], "active": 1, "response": [1,0]}
-        print(f"INFO: {sensor} REGISTERED at {timestamp} \n ")
+    timestamp = dictionary["header"]["time_stamp"]
+    token = (token_base + token_counter) * WORKERS + WORKER_ID
+    
+    token_counter += 1
+    
+    sensor = dictionary["header"]["sensor_id"]
+    fmt = messages.negotiate(dictionary["header"]["data"].get("formats", ()), sensor)
     
-    response = messages.registration_message(sensor, token)
+    old = sensors.get(sensor)
+    if old is not None:
+        deltas.forget(old.token)
     
-    server.send_response(response)
+    state = sensors.register(sensor, token, fmt, timestamp)
+    if fmt == "delta":
+        deltas.register(token, sensor)
+    print(f"INFO: {sensor} REGISTERED at {timestamp} ({fmt}) \n ")
+    
+    state.address = client
+    
+    response = messages.registration_message(sensor, token, (fmt,), "legacy" if fmt == "legacy" else "json")
+    
+    server.send_response(response, client)
     
     return
 
-def handle_data(dictionary, server):
+def handle_data(dictionary, server, client):
     
     sensor = dictionary["header"]["sensor_id"]
     token = dictionary["header"]["token"]
-    ack_response = 0
+    state = sensors.get(sensor)
     
-    with LOCK:
-        if sensors[sensor]["token"] == token: 
-            
-            if dictionary["header"]["battery"] == "low":
-                sensors[sensor]["battery"] = "low"
-            
-            sensors[sensor]["active"] = 1
-            
-            if sensors[sensor]["response"][0] == 1:
-                ack_response = 1
-                sensors[sensor]["data"].append(dictionary)
-                sensors[sensor]["log"].append(False)
-            elif sensors[sensor]["response"][0] == 0 and sensors[sensor]["response"][1] < 3:
-                sensors[sensor]["response"][1] += 1
-            else:
-                sensors[sensor]["response"][0] = 1
-                sensors[sensor]["response"][1] = 0
-                ack_response = 1
-                sensors[sensor]["data"].append(dictionary)
-                sensors[sensor]["log"].append(False)
+    if state is None or state.token != token:
+        stats.count("unknown_token")
+        return
+    
+    ack_response = accept(state, dictionary["header"], dictionary["header"]["msg_type"] == "data")
+    
+    state.address = client
     
     if ack_response:
-        ack = messages.sensor_message(dictionary["header"]["sensor_id"], token, {"ack":1}, dictionary["header"]["battery"], "ack", dictionary["header"]["time_stamp"])
-        server.send_response(ack)
+        ack = messages.control_message(sensor, token, dictionary["header"]["battery"], "ack", dictionary["header"]["time_stamp"], state.format, dictionary["header"].get("seq"), state.templates)
+        server.send_response(ack, state.address)
+        stats.count("acks_sent")
 
-def handle_corrupted(dictionary, server, error):
+def handle_batch(dictionary, server, client, fmt):
+    # the batch ack goes back in the format the batch came in
+    header = dictionary["header"]
+    bitmap = 0
+    
+    for i, reading in enumerate(header["data"]["readings"][:messages.BATCH_MAX]):
+        state = sensors.get(reading["sensor_id"])
+        
+        if state is None or state.token != reading["token"]:
+            stats.count("unknown_token")
+            continue
+        
+        state.address = client # heard from, whether or not the ACK is withheld
+        if accept(state, reading, True):
+            bitmap |= 1 << i
+    
+    ack = messages.batch_ack_message(header["sensor_id"], bitmap, header["time_stamp"], fmt, header.get("seq"))
+    server.send_response(ack, client)
+    stats.count("batch_acks_sent")
+
+def accept(state, header, reading):
+    # returns 1 when the message is to be acknowledged
+    ack_response = 0
+    
+    if reading and not storable(state.sensor_id, header["data"]):
+        stats.count("invalid_readings")
+        return 0 # not acked, so a corrected reading can follow under the same seq
+    
+    if header["battery"] == "low":
+        state.battery = "low"
+    
+    sensors.touch(state, header["time_stamp"])
+    
+    if state.respond == 1:
+        ack_response = 1
+    elif state.respond == 0 and state.withheld < 3:
+        state.withheld += 1
+    else:
+        state.respond = 1
+        state.withheld = 0
+        ack_response = 1
+    
+    # duplicates are acked again, the first ACK may have been lost, but stored once
+    if ack_response and reading and not sensors.fresh(state, header.get("seq")):
+        stats.count("duplicates")
+    elif ack_response and reading:
+        store(state, header)
+        if state.format == "delta":
+            deltas.acked(state.token, header.get("seq"), header["time_stamp"], header["data"])
+    
+    return ack_response
+
+def storable(sensor_id, data):
+    # storage, the archive and the aggregates take finite numbers that fit
+    # the sensor's record layout; JSON readings are not checked elsewhere
+    if not isinstance(data, dict):
+        return False
+    for value in data.values():
+        if type(value) is int and -1 << 63 <= value < 1 << 63:
+            continue
+        if type(value) is float and math.isfinite(value):
+            continue
+        return False
+    
+    schema = messages.payload_schemas.get(messages.sensor_type(sensor_id))
+    if schema is not None:
+        layout, fields, scales = schema
+        try:
+            layout.pack(*[round(data.get(field, 0) * scale) for field, scale in zip(fields, scales)])
+        except struct.error:
+            return False
+    return True
+
+def store(state, header):
+    if state.readings is None:
+        state.readings = storage.readings_for(state.sensor_id, header["data"])
+    state.readings.append(header["time_stamp"], header["data"])
+    if archive is not None:
+        archive.append(state.sensor_id, header["time_stamp"], header["data"])
+    aggregates.add(state.sensor_id, header["time_stamp"], header["data"])
+    if not outputs.push(state.sensor_id, header["time_stamp"], state.battery, header["data"]):
+        stats.count("output_drops")
+
+def handle_corrupted(dictionary, server, error, client):
     
     ack_response = 0
     
@@ -210,15 +426,21 @@ def handle_corrupted(dictionary, server, error):
     time_stamp = dictionary["header"]["time_stamp"]
     token = dictionary["header"]["token"]
     battery = dictionary["header"]["battery"]
+    state = sensors.get(sensor)
+    
+    if state is None or state.token != token:
+        stats.count("unknown_token")
+        return
         
-    if error == 0 and sensors[sensor]["token"] == token:
+    if error == 0:
     
         print(f"{'\033[32m'} INFO: {sensor} CORRUTPED DATA at {time_stamp}. REQUESTING DATA {'\033[0m'} \n")
         
-        msg = messages.sensor_message(sensor, token, {"error":1}, battery, "error", time_stamp)
-        server.send_response(msg)
+        msg = messages.control_message(sensor, token, battery, "error", time_stamp, state.format, dictionary["header"].get("seq"), state.templates)
+        server.send_response(msg, state.address or client)
+        stats.count("retransmit_requests")
     
-    elif error == 1 and sensors[sensor]["token"] == token:
+    elif error == 1:
         if battery == "high":
             print(f" {time_stamp} - {sensor}  ")
         else:
@@ -226,56 +448,95 @@ def handle_corrupted(dictionary, server, error):
         for key, value in dictionary["header"]["data"].items():
             print(f"{'\033[32m'} {key}: {value},{'\033[0m'} ")
         print("\n ")
-        ack = messages.sensor_message(dictionary["header"]["sensor_id"], token, {"ack":1}, dictionary["header"]["time_stamp"], "ack", 0)
-        server.send_response(ack) 
+        ack = messages.control_message(sensor, token, battery, "ack", time_stamp, state.format, dictionary["header"].get("seq"), state.templates)
+        state.address = client
+        server.send_response(ack, state.address)
+        stats.count("acks_sent")
         
                                     
 
 def listen(server):
-    global unix_time
+    server.set_receive_timeout(1)
+    checked = time.monotonic()
     
     while (True):
-        unix_time = int(time.time())
+        server.pump()
         
-        data, client_ip = server.receive()
-        process_message(data, server)
+        if time.monotonic() - checked >= 1:
+            checked = time.monotonic()
+            activity_check(server)
         
                             
 def logger():
+    outputs.run()
+
+async def logger_task():
     
     while True:
-        time.sleep(10)
-        
-        with LOCK:
-            for sensor_id, value1 in sensors.items():
-                    if value1 != None:
-                        for i in range (len(value1["log"])):
-                            
-                            header = value1["data"][i]["header"]
-                            time_stamp = header["time_stamp"]
-                            sensor_id = header["sensor_id"]
-                            
-                            if value1["log"][i] != True:
-                                
-                                if value1["battery"] == "high":
-                                    print(f" {time_stamp} - {sensor_id}  ")
-                                else:
-                                    print(f" \033[31m{time_stamp} - WARNING: LOW BATTERY {sensor_id}  \033[0m")
-                                for key, value in header["data"].items():
-                                    print(f" {key}: {value},")
-                                print("\n ") 
-                                value1["log"][i] = True     
-                        
+        await asyncio.sleep(1)
+        await asyncio.to_thread(outputs.flush)
+
+async def serve(server):
+    # one reader callback drains the socket and flushes its replies per wakeup
+    loop = asyncio.get_running_loop()
+    
+    def pump():
+        server.pump(False)
+        if server.backlog:
+            loop.call_soon(pump) # keep working through the backlog between reads
+    
+    server.sock.setblocking(False)
+    loop.add_reader(server.sock.fileno(), pump)
+    
+    try:
+        await asyncio.gather(logger_task(), activity_check_task(server))
+    finally:
+        loop.remove_reader(server.sock.fileno())
                         
                                   
         
         
 
     
+def open_archive(directory=segments.DIRECTORY):
+    global archive
+    
+    if archive is None:
+        archive = segments.SegmentStore(directory, lock=metrics.TimedLock(stats, "archive_lock"))
+
+def worker(server_ip, server_port, worker_id, workers):
+    # the kernel hashes each source address to one socket, so a sensor keeps
+    # talking to the worker that registered it and state needs no sharing
+    global WORKERS, WORKER_ID
+    
+    WORKERS = workers
+    WORKER_ID = worker_id
+    if stats.path is not None:
+        stats.path = f"{stats.path}.worker-{worker_id}"
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    server = Server(server_ip, server_port, reuse_port=True)
+    open_archive(os.path.join(segments.DIRECTORY, f"worker-{worker_id}"))
+    
+    try:
+        asyncio.run(serve(server))
+    finally:
+        outputs.close()
+        archive.close()
+
+def serve_workers(server_ip, server_port, workers):
+    processes = [multiprocessing.Process(target=worker, args=(server_ip, server_port, worker_id, workers), daemon=True) for worker_id in range(workers)]
+    
+    for process in processes:
+        process.start()
+    
+    return processes
+
 if __name__=="__main__":
     
     possibilities = ["1", "2", "q"]
     server = None
+    processes = []
     
     while (True):
         
@@ -292,42 +553,118 @@ if __name__=="__main__":
             
             if server != None:
                 print(f"{'\033[32m'} Starting server at {server_ip}:{server_port} {'\033[0m'} \n ")
+                open_archive()
             
                 threading.Thread(target=listen, args=(server,), daemon=True).start()
                 threading.Thread(target=logger, daemon=True).start()
-                threading.Thread(target=activity_check, args=(server,),daemon=True).start()
+            
+        elif choice == "4":
+            
+            if server != None:
+                print(f"{'\033[32m'} Starting asyncio server at {server_ip}:{server_port} {'\033[0m'} \n ")
+                open_archive()
+                
+                threading.Thread(target=asyncio.run, args=(serve(server),), daemon=True).start()
             
             
         elif choice == "3":
             print(" --- Select sensor --- \n")
             i = 1
             
-            with LOCK:    
-                for key, value in sensors.items():
-                        
-                    token = value["token"]
-                        
-                    if token != None:
-                            
-                        print(f" {i}. {key} \n") 
-                        i += 1
+            for sensor_id, token, battery, fmt, active, last_seen in sensors.snapshot():
                     
-                if i == 1:
-                    print(" sensors do not have tokens yet! \n ")
-                    continue
+                if token != None:
+                        
+                    print(f" {i}. {sensor_id} \n") 
+                    i += 1
+                
+            if i == 1:
+                print(" sensors do not have tokens yet! \n ")
+                continue
                 
             sensorchoice = "none"
                 
             while sensorchoice not in sensors:       
                 sensorchoice = input(" Input your choice: (string name) ")
                 
-            with LOCK:
-                sensors[sensorchoice]["response"][0] = 0
+            sensors.get(sensorchoice).respond = 0 # one attribute store, read by the receive path
                 
                 
         
+        elif choice == "6":
+            
+            if server != None and not processes:
+                workers = int(input(" workers = "))
+                stats.unwatch(server.sock)
+                server.sock.close() # the workers bind their own SO_REUSEPORT sockets
+                print(f"{'\033[32m'} Starting {workers} workers at {server_ip}:{server_port} {'\033[0m'} \n ")
+                
+                processes = serve_workers(server_ip, server_port, workers)
+        
+        elif choice == "7":
+            port = int(input(" http port = "))
+            path = input(" snapshot file (empty for none) = ")
+            
+            stats.serve(port)
+            if path:
+                stats.path = path
+            print(f"{'\033[32m'} metrics at http://127.0.0.1:{port}/ {'\033[0m'} \n")
+        
+        elif choice == "8":
+            sensorchoice = input(" sensor: (string name) ")
+            resolution = int(input(f" resolution in seconds {tuple(aggregates.resolutions)} = "))
+            
+            if sensorchoice not in aggregates or resolution not in aggregates.resolutions:
+                print(" no aggregates for that sensor and resolution! \n ")
+                continue
+            
+            for start, fields in aggregates.query(sensorchoice, resolution)[-10:]:
+                print(f" {start} - {sensorchoice}  ")
+                for field, values in fields.items():
+                    print(f"{'\033[32m'} {field}: mean={values['mean']:.2f} min={values['min']} max={values['max']} last={values['last']} ({values['count']}){'\033[0m'} ")
+                print("\n ")
+        
+        elif choice == "10":
+            kind = input(f" sensor type {tuple(messages.sensors_map)} = ")
+            condition = input(" filter 'field min max', - leaves a side open (empty for none) = ").split()
+            
+            table = query.table(sensors, kind)
+            bounds = {}
+            if len(condition) == 3 and condition[0] in table.fields:
+                field, low, high = condition
+                bounds[field] = (None if low == "-" else float(low), None if high == "-" else float(high))
+            table = table.where(**bounds)
+            
+            print(f" {len(table)} {kind} readings from {len(table.sensors())} sensors  ")
+            for field, values in table.aggregate().items():
+                print(f"{'\033[32m'} {field}: mean={values['mean']:.2f} min={values['min']} max={values['max']} ({values['count']}){'\033[0m'} ")
+            print("\n ")
+        
+        elif choice == "9" and server != None:
+            path = input(" capture file path = ")
+            
+            server.capture = capture.Capture(path)
+            print(f"{'\033[32m'} capturing datagrams to {path} {'\033[0m'} \n")
+        
+        elif choice == "5":
+            path = input(" file path (.jsonl for json lines) = ")
+            
+            if path.endswith(".jsonl"):
+                outputs.add(output.JsonlSink(path))
+            else:
+                outputs.add(output.FileSink(path))
+            print(f"{'\033[32m'} logging readings to {path} {'\033[0m'} \n")
+        
         elif choice == "q" and server != None:
+            for process in processes:
+                process.terminate()
+                process.join()
             server.quit()
+            if server.capture is not None:
+                server.capture.close()
+            outputs.close()
+            if archive is not None:
+                archive.close()
             break
         
         else:
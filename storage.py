@@ -0,0 +1,113 @@
+from array import array
+
+import messages
+
+CAPACITY = 4096          # readings kept per sensor
+RETENTION = 24 * 3600    # seconds a reading is kept, 0 keeps until overwritten
+
+
+class RingBuffer:
+
+    def __init__(self, fields, typecodes, capacity=CAPACITY, retention=RETENTION) -> None:
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.retention = retention
+        self.time = array("q", bytes(8 * capacity))
+        self.columns = {field: array(code, bytes(array(code).itemsize * capacity)) for field, code in zip(self.fields, typecodes)}
+        self.casts = [(field, int if code == "q" else float) for field, code in zip(self.fields, typecodes)]
+        self.head = 0    # physical slot of the oldest reading
+        self.size = 0
+        self.total = 0   # readings ever appended
+
+    def __len__(self):
+        return self.size
+
+    def append(self, time_stamp, data):
+        # kept in time order for _bisect: a late reading (retransmit, reorder)
+        # shifts the newer ones up a slot, a full buffer drops the oldest
+        values = [cast(data.get(field, 0)) for field, cast in self.casts]
+
+        if self.size == self.capacity:
+            if time_stamp < self.time[self.head]:
+                return  # older than everything kept, it would go first
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+
+        position = self.size
+        if self.size and time_stamp < self.time[(self.head + self.size - 1) % self.capacity]:
+            position = self._bisect(time_stamp + 1)
+        for i in range(self.size, position, -1):
+            slot, previous = (self.head + i) % self.capacity, (self.head + i - 1) % self.capacity
+            self.time[slot] = self.time[previous]
+            for column in self.columns.values():
+                column[slot] = column[previous]
+
+        slot = (self.head + position) % self.capacity
+        self.time[slot] = time_stamp
+        for column, value in zip(self.columns.values(), values):
+            column[slot] = value
+
+        self.size += 1
+        self.total += 1
+
+        if self.retention:
+            self.expire(self.time[(self.head + self.size - 1) % self.capacity] - self.retention)
+
+    def expire(self, before):
+        while self.size and self.time[self.head] < before:
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+
+    def reading(self, i):
+        slot = (self.head + i) % self.capacity
+        return self.time[slot], {field: self.columns[field][slot] for field in self.fields}
+
+    def last(self, n):
+        n = min(n, self.size)
+        return [self.reading(i) for i in range(self.size - n, self.size)]
+
+    def between(self, start, end):
+        first = self._bisect(start)
+        stop = self._bisect(end + 1)
+        return [self.reading(i) for i in range(first, stop)]
+
+    def arrays(self, start=None, end=None):
+        # readings in [start, end] as {"time": array, field: array}, oldest
+        # first; every column is copied in at most two slices of the ring
+        first = 0 if start is None else self._bisect(start)
+        stop = self.size if end is None else self._bisect(end + 1)
+        low, high = self.head + first, self.head + stop
+        result = {}
+
+        for name, column in (("time", self.time),) + tuple(self.columns.items()):
+            if high <= self.capacity:
+                result[name] = column[low:high]
+            elif low >= self.capacity:
+                result[name] = column[low - self.capacity:high - self.capacity]
+            else:
+                result[name] = column[low:] + column[:high - self.capacity]
+
+        return result
+
+    def _bisect(self, time_stamp):
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if self.time[(self.head + mid) % self.capacity] < time_stamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+
+def readings_for(sensor_id, data=None, capacity=CAPACITY, retention=RETENTION):
+    schema = messages.payload_schemas.get(messages.sensor_type(sensor_id))
+
+    if schema is not None:
+        layout, fields, scales = schema
+        typecodes = ["q" if scale == 1 else "d" for scale in scales]
+    else:
+        fields = sorted(data or ())
+        typecodes = ["d"] * len(fields)
+
+    return RingBuffer(fields, typecodes, capacity, retention)
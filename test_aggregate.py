@@ -0,0 +1,44 @@
+import unittest
+
+import aggregate
+
+
+class SeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.series = aggregate.Series(("co2", "ozone"), 60, 4)
+
+    def test_bucket_statistics(self):
+        for time_stamp, co2 in ((0, 400), (30, 600), (20, 500), (60, 450)):
+            self.series.add(time_stamp, [co2, None])
+
+        self.assertEqual(self.series.query(), [
+            (0, {"co2": {"count": 3, "mean": 500, "min": 400, "max": 600, "last": 600}}),
+            (60, {"co2": {"count": 1, "mean": 450, "min": 450, "max": 450, "last": 450}}),
+        ])
+
+    def test_wrap_around_starts_a_new_row(self):
+        self.series.add(0, [400, 1.5])
+        old = self.series.rows[0]
+        self.series.add(240, [500, None])
+
+        self.assertEqual(old[0], [1, 1])  # a reader holding the old row still sees it whole
+        self.assertEqual(self.series.query(), [(240, {"co2": {"count": 1, "mean": 500, "min": 500, "max": 500, "last": 500}})])
+
+    def test_late_reading_of_a_missing_field(self):
+        self.series.add(30, [400, None])
+        self.series.add(10, [None, 2.5])
+
+        self.assertEqual(self.series.summary()["ozone"]["last"], 2.5)
+
+    def test_statistics_skip_unpublished_rows(self):
+        # what a reader sees between the two writes of an add()
+        self.series.add(0, [400, None])
+        self.series.start[1] = 60
+        self.series.rows[0][0][1] = 1
+
+        self.assertEqual(self.series.summary(), {"co2": {"count": 1, "mean": 400, "min": 400, "max": 400, "last": 400}})
+
+
+if __name__ == "__main__":
+    unittest.main()
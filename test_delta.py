@@ -0,0 +1,72 @@
+import unittest
+
+import delta
+
+TOKEN = 1792000000000
+READINGS = [
+    {"temperature": 21.5, "humidity": 40.0, "dew_point": 7.5, "pressure": 1013.25},
+    {"temperature": 21.7, "humidity": 40.0, "dew_point": 7.5, "pressure": 1013.2},
+    {"temperature": 21.6, "humidity": 41.5, "dew_point": 7.8, "pressure": 1013.2},
+]
+
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = delta.Encoder("ThermoNode-1", TOKEN)
+        self.decoder = delta.Decoder(window=4)
+        self.decoder.register(TOKEN, "ThermoNode-1")
+
+    def send(self, data, seq, time_stamp):
+        packet = self.encoder.encode(data, "high", seq, time_stamp)
+        dictionary, valid = self.decoder.load(packet)
+        return packet[2] & delta.FLAG_KEYFRAME, dictionary, valid
+
+    def ack(self, dictionary):
+        # the server stores and acks the reading, the ack reaches the sensor
+        header = dictionary["header"]
+        self.decoder.acked(header["token"], header["seq"], header["time_stamp"], header["data"])
+        self.encoder.acked(header["seq"])
+
+    def test_keyframe_then_delta(self):
+        keyframe, dictionary, valid = self.send(READINGS[0], 1, 1000)
+        self.assertTrue(keyframe and valid)
+        self.assertEqual(dictionary["header"]["data"], READINGS[0])
+        self.ack(dictionary)
+
+        for seq, data in enumerate(READINGS[1:], 2):
+            keyframe, dictionary, valid = self.send(data, seq, 1000 + seq)
+            self.assertFalse(keyframe)
+            self.assertTrue(valid)
+            self.assertEqual((dictionary["header"]["sensor_id"], dictionary["header"]["time_stamp"]), ("ThermoNode-1", 1000 + seq))
+            self.assertEqual(dictionary["header"]["data"], data)
+            self.ack(dictionary)
+
+    def test_evicted_base_is_invalid_until_keyframe(self):
+        keyframe, dictionary, valid = self.send(READINGS[0], 1, 1000)
+        self.ack(dictionary)
+
+        # the decoder acks seqs 2..5 but the acks are lost, so the encoder
+        # keeps seq 1 as its base, which drops out of the decoder's window
+        for seq in range(2, 6):
+            self.decoder.acked(TOKEN, seq, 1000 + seq, READINGS[0])
+        keyframe, dictionary, valid = self.send(READINGS[1], 6, 1006)
+        self.assertFalse(keyframe)
+        self.assertFalse(valid)
+
+        self.encoder.keyframe()
+        keyframe, dictionary, valid = self.send(READINGS[1], 7, 1007)
+        self.assertTrue(keyframe and valid)
+        self.assertEqual(dictionary["header"]["data"], READINGS[1])
+
+    def test_reordered_seq_is_sent_as_keyframe(self):
+        keyframe, dictionary, valid = self.send(READINGS[0], 5, 1000)
+        self.ack(dictionary)
+
+        keyframe, dictionary, valid = self.send(READINGS[1], 3, 1001)
+        self.assertTrue(keyframe and valid)
+        self.assertEqual((dictionary["header"]["seq"], dictionary["header"]["data"]), (3, READINGS[1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import socket
+import sys
+import unittest
+
+import metrics
+
+
+class ReceiveDropsTest(unittest.TestCase):
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "reads /proc/net/udp")
+    def test_closed_socket_does_not_hide_the_others(self):
+        stats = metrics.Metrics()
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        live = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        live.bind(("127.0.0.1", 0))
+        self.addCleanup(live.close)
+
+        stats.watch(closed)
+        stats.watch(live)
+        closed.close()
+        self.assertEqual(stats.snapshot()["counters"]["receive_drops"], 0)
+
+    def test_unwatch(self):
+        stats = metrics.Metrics()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        stats.watch(sock)
+        stats.unwatch(sock)
+        sock.close()
+
+        self.assertEqual(stats.sockets, [])
+        self.assertNotIn("receive_drops", stats.snapshot()["counters"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+
+import registry
+
+
+class FreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sensors = registry.Registry()
+        self.state = self.sensors.register("ThermoNode-1", 1, "binary", 0)
+
+    def test_duplicates_inside_the_window(self):
+        self.assertEqual([self.sensors.fresh(self.state, seq) for seq in (5, 3, 5, 3, 4)], [True, True, False, False, True])
+
+    def test_seq_older_than_the_window(self):
+        self.assertTrue(self.sensors.fresh(self.state, 100))
+        self.assertTrue(self.sensors.fresh(self.state, 100 - registry.SEQ_WINDOW + 1))
+        self.assertFalse(self.sensors.fresh(self.state, 100 - registry.SEQ_WINDOW))
+
+    def test_huge_gap_is_rejected_without_building_the_bit(self):
+        # 1 << gap would be a 10**15 bit integer
+        for top in (2 ** 32 - 1, 10 ** 15):
+            self.assertTrue(self.sensors.fresh(self.state, top))
+            self.assertFalse(self.sensors.fresh(self.state, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import tempfile
+import unittest
+
+import segments
+import tester
+
+
+class SegmentStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.store = self.open()
+
+    def open(self):
+        store = segments.SegmentStore(self.directory, segment_records=8)
+        self.addCleanup(store.close)
+        return store
+
+    def append(self, store, times, sensor_id="ThermoNode-1"):
+        for time_stamp in times:
+            store.append(sensor_id, time_stamp, tester.create_data(sensor_id))
+
+    def test_query_across_segments(self):
+        self.append(self.store, range(20))
+        self.append(self.store, range(20, 25), "ThermoNode-2")
+
+        self.assertEqual([time_stamp for time_stamp, sensor_id, data in self.store.query("ThermoNode", 5, 21)], list(range(5, 22)))
+        self.assertEqual([time_stamp for time_stamp, sensor_id, data in self.store.query("ThermoNode", sensor_id="ThermoNode-2")], list(range(20, 25)))
+
+    def test_replay_while_appending(self):
+        # the generator reads what was stored when it started, the records
+        # appended meanwhile may not be on disk yet
+        self.append(self.store, range(9))
+        replay = self.store.replay("ThermoNode")
+        self.assertEqual(next(replay)[0], 0)
+
+        self.append(self.store, (9, 10))
+        self.assertEqual([time_stamp for time_stamp, sensor_id, data in replay], list(range(1, 9)))
+        self.assertEqual(len(self.store.query("ThermoNode")), 11)
+
+    def test_reopen_keeps_readings(self):
+        self.append(self.store, range(12))
+        self.store.close()
+
+        store = self.open()
+        self.append(store, (12,))
+        self.assertEqual([time_stamp for time_stamp, sensor_id, data in store.query("ThermoNode", 6)], list(range(6, 13)))
+
+
+if __name__ == "__main__":
+    unittest.main()
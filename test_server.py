@@ -0,0 +1,140 @@
+import contextlib
+import io
+import socket
+import unittest
+
+import delta
+import messages
+import metrics
+import output
+import registry
+import server
+import tester
+
+
+class Replies:
+    # stands in for server.Server, collecting the replies
+
+    def __init__(self) -> None:
+        self.sent = []
+
+    def send_response(self, data, client):
+        self.sent.append(data)
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        server.sensors = registry.Registry()
+        server.stats = metrics.Metrics()
+        server.outputs = output.Pipeline([])
+        server.deltas = delta.Decoder()
+        self.client = ("127.0.0.1", 9)
+        self.replies = Replies()
+
+    def register(self, sensor_id, fmt="json"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.process_message(messages.registration_message(sensor_id, None, (fmt,)).encode("utf-8"), self.replies, self.client)
+        return server.sensors.get(sensor_id).token
+
+    def send(self, sensor_id, token, data, seq):
+        msg = messages.sensor_message(sensor_id, token, data, "high", "data", 0, "json", seq)
+        sent = len(self.replies.sent)
+        server.process_message(msg.encode("utf-8"), self.replies, self.client)
+        return len(self.replies.sent) - sent
+
+    def test_invalid_reading_is_not_stored_or_acked(self):
+        token = self.register("ThermoNode-1")
+        data = tester.create_data("ThermoNode-1")
+
+        for value in (None, "hot", 1e9, float("inf")):
+            self.assertEqual(self.send("ThermoNode-1", token, dict(data, temperature=value), 1), 0)
+        self.assertEqual(server.stats.counters["invalid_readings"], 4)
+
+        # the corrected reading reuses the seq and is not taken for a duplicate
+        self.assertEqual(self.send("ThermoNode-1", token, data, 1), 1)
+        self.assertEqual(len(server.sensors.get("ThermoNode-1").readings), 1)
+
+    def test_batch_ack_uses_the_batch_format(self):
+        token = self.register("ThermoNode-1", "legacy")
+
+        for fmt in ("binary", "json"):
+            entry = messages.reading("ThermoNode-1", token, tester.create_data("ThermoNode-1"), "high", 1)
+            msg = messages.batch_message("Gateway", [entry], fmt, 1)
+            server.process_message(msg.encode("utf-8") if isinstance(msg, str) else msg, self.replies, self.client)
+
+            reply = self.replies.sent[-1]
+            self.assertEqual(messages.format_of(reply.encode("utf-8") if isinstance(reply, str) else reply), fmt)
+
+    def test_ack_templates_are_dropped_on_registration(self):
+        data = tester.create_data("ThermoNode-1")
+        token = self.register("ThermoNode-1")
+        for seq in (1, 2, 3):
+            self.send("ThermoNode-1", token, data, seq)
+        self.assertEqual(len(server.sensors.get("ThermoNode-1").templates), 1)
+
+        token = self.register("ThermoNode-1")
+        self.send("ThermoNode-1", token, data, 1)
+        ack = messages.load(self.replies.sent[-1])[0]["header"]
+        self.assertEqual((ack["msg_type"], ack["token"], ack["seq"]), ("ack", token, 1))
+
+    def test_output_queue_is_bounded(self):
+        server.outputs = output.Pipeline([], limit=2)
+        data = tester.create_data("ThermoNode-1")
+        token = self.register("ThermoNode-1")
+
+        self.assertEqual(sum(self.send("ThermoNode-1", token, data, seq) for seq in (1, 2, 3)), 3)
+        self.assertEqual(len(server.sensors.get("ThermoNode-1").readings), 3)
+        self.assertEqual(len(server.outputs.drain()), 2)
+        self.assertEqual(server.stats.counters["output_drops"], 1)
+
+    def test_unknown_msg_types_share_one_counter(self):
+        for i in range(100):
+            msg = messages.sensor_message("ThermoNode-1", 1, {"junk": 1}, "high", f"junk{i}", 0, "json", 1)
+            server.process_message(msg.encode("utf-8"), self.replies, self.client)
+        self.register("ThermoNode-1")
+
+        self.assertEqual(server.stats.counters["packets_unknown"], 100)
+        self.assertEqual(server.stats.counters["packets_registration"], 1)
+        self.assertFalse([name for name in server.stats.counters if name.startswith("packets_junk")])
+
+    def test_tokens_do_not_follow_the_sensor_clock(self):
+        def register(sensor_id, time_stamp):
+            dictionary = {"header": {"sensor_id": sensor_id, "time_stamp": time_stamp, "data": {"formats": ["delta"]}}}
+            with contextlib.redirect_stdout(io.StringIO()):
+                server.handle_registration(dictionary, self.replies, self.client)
+            return server.sensors.get(sensor_id).token
+
+        # the same counter + time stamp sum used to give the same token
+        first = register("ThermoNode-A", 1001)
+        for i in range(999):
+            register(f"ThermoNode-{i}", 1001)
+        second = register("ThermoNode-B", 1000)
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(server.deltas.streams[first].sensor_id, "ThermoNode-A")
+
+    def test_flood_is_shed_with_slow_down(self):
+        srv = server.Server("127.0.0.1", 0)
+        self.addCleanup(srv.sock.close)
+        sensor = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sensor.close)
+        sensor.connect(srv.sock.getsockname())
+        sensor.settimeout(1)
+
+        # an unknown token gets no ACKs, so slow_down is the only reply
+        data = messages.sensor_message("ThermoNode-1", 1, tester.create_data("ThermoNode-1"), "high", "data", 0, "binary", 1)
+        for _ in range(server.INGRESS_LIMIT // (server.READ_BUDGET - server.PUMP_BUDGET) + 2):
+            for _ in range(server.READ_BUDGET):
+                sensor.send(data)
+            srv.pump(False)
+
+        self.assertEqual(len(srv.backlog), server.INGRESS_LIMIT - server.PUMP_BUDGET) # full, then one handler round
+        self.assertGreater(server.stats.counters["shed"], 0)
+        reply = messages.load(sensor.recv(2048))[0]
+        self.assertEqual(reply["header"]["msg_type"], "slow_down")
+        self.assertEqual(reply["header"]["data"], {"slow_down": server.SLOW_DOWN})
+
+
+if __name__ == "__main__":
+    unittest.main()
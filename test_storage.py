@@ -0,0 +1,54 @@
+import unittest
+
+import query
+import registry
+import storage
+
+
+def ring(times, capacity=8):
+    buffer = storage.RingBuffer(("co2",), ("q",), capacity, retention=0)
+    for time_stamp in times:
+        buffer.append(time_stamp, {"co2": time_stamp * 10})
+    return buffer
+
+
+class LateReadingTest(unittest.TestCase):
+
+    def test_between_with_one_late_reading(self):
+        buffer = ring([10, 11, 12, 5, 13, 14])
+
+        self.assertEqual([time_stamp for time_stamp, data in buffer.between(10, 14)], [10, 11, 12, 13, 14])
+        self.assertEqual(buffer.between(5, 5), [(5, {"co2": 50})])
+
+    def test_arrays_after_wrap_around(self):
+        buffer = ring([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 4], capacity=8)
+
+        columns = buffer.arrays(4, 6)
+        self.assertEqual(list(columns["time"]), [4, 4, 5, 6])
+        self.assertEqual(list(columns["co2"]), [40, 40, 50, 60])
+        self.assertEqual(list(buffer.arrays()["time"]), [4, 4, 5, 6, 7, 8, 9, 10])
+
+    def test_full_buffer_drops_reading_older_than_all(self):
+        buffer = ring([5, 6, 7, 8], capacity=4)
+        buffer.append(1, {"co2": 10})
+
+        self.assertEqual(list(buffer.arrays()["time"]), [5, 6, 7, 8])
+
+    def test_retention_counts_from_the_newest_reading(self):
+        buffer = storage.RingBuffer(("co2",), ("q",), 8, retention=10)
+        for time_stamp in (100, 105, 80):
+            buffer.append(time_stamp, {"co2": 1})
+
+        self.assertEqual(list(buffer.arrays()["time"]), [100, 105])
+
+    def test_query_table_time_range(self):
+        sensors = registry.Registry()
+        state = sensors.register("AirQualityBox-1", 1, "binary", 0)
+        state.readings = ring([10, 11, 12, 5, 13, 14])
+
+        table = query.table(sensors, "AirQualityBox", 10, 14)
+        self.assertEqual(list(table.columns["time"]), [10, 11, 12, 13, 14])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,43 +1,55 @@
-import json
+import heapq
 import socket
-import crc
 import threading
 import time
 import messages
 import random
 
-import struct
+RETRANSMIT_TIMEOUT = 1.0   # seconds before the first retransmit, doubled per attempt
+MAX_BACKOFF = 30.0
+MAX_ATTEMPTS = 8
+MAX_IN_FLIGHT = 8          # unacknowledged data messages per sensor
+MAX_BATCHES = 1024         # unacknowledged batches remembered for their bitmap
 
-CRC_CALCULATOR = crc.Calculator(crc.Crc32.CRC32)
-
-unix_time = 0
+GATEWAY_ID = "Gateway"
 
 LOCK = threading.Lock()
 
-sensors = {
-    "ThermoNode": None,
-    "WindSense" : None,
-    "RainDetect": None,
-    "AirQualityBox": None
-}
+sensors = {}
+
+retransmits = [] # heap of (due, sensor_id, seq), stale entries are skipped
 
-### binary
-sensors_map = {
-    "ThermoNode": 0,
-    "WindSense" : 1,
-    "RainDetect": 2,
-    "AirQualityBox": 3
-}
+batching = False
+batch_seq = 0
+batches = {}     # batch seq -> [(sensor_id, seq)] in bitmap order
 
-msg_type_mag = {
-    "error": 0,
-    "activity": 1,
-    "ack": 2,
-    "data": 3,
-    "registration": 4
-}
+slow_until = 0.0 # monotonic time until which the server asked us to hold back
 
-###binary
+class VirtualSensor:
+    
+    __slots__ = ("token", "battery", "seq", "outstanding", "active", "format")
+    
+    def __init__(self, token, fmt) -> None:
+        self.token = token
+        self.battery = "high"
+        self.seq = 0
+        self.outstanding = {} # seq -> Pending
+        self.active = 1
+        self.format = fmt
+
+class Pending:
+    
+    __slots__ = ("message", "attempts", "due")
+    
+    def __init__(self, message, due) -> None:
+        self.message = message
+        self.attempts = 0
+        self.due = due
+
+def sensor_ids(count=1):
+    if count == 1:
+        return list(messages.sensors_map)
+    return [f"{kind}-{i}" for kind in messages.sensors_map for i in range(count)]
 
 class Client:
     
@@ -64,7 +76,9 @@ class Client:
             return None ############
 
     def send_message(self, message):
-        self.sock.sendto(bytes(message,encoding="utf8"),(self.server_ip,self.server_port))
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        self.sock.sendto(message,(self.server_ip,self.server_port))
 
     def quit(self):
         self.sock.close() # correctly closing socket
@@ -76,6 +90,7 @@ def menu():
     print(" 1: Set IPs and ports (configure) ")
     print(" 2: auto message generation ")
     print(" 3: send custom message ")
+    print(" 4: toggle batched sending ")
     print(" q: leave menu  ")
     print(" ------------")
     
@@ -97,15 +112,55 @@ def register(sensor_id, client):
     json_message = messages.registration_message(sensor_id, None)
     client.send_message(json_message)
     msg = client.receive()
-    token = process_message(msg)["header"]["token"]
-    sensors[sensor_id] = [token, "high", [], 1, []]
+    header = process_message(msg)["header"]
+    token = header["token"]
+    fmt = header["data"].get("formats", ["legacy"])[0]
+    sensors[sensor_id] = VirtualSensor(token, fmt)
         
 def process_message(data):
-    data = data.decode("utf-8")
-    return json.loads(data)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return messages.load(data)[0]
+
+def track(sensor_id, sensor, message):
+    due = time.monotonic() + RETRANSMIT_TIMEOUT
+    sensor.outstanding[message["header"]["seq"]] = Pending(message, due)
+    heapq.heappush(retransmits, (due, sensor_id, message["header"]["seq"]))
+
+def find_pending(sensor, header):
+    seq = header.get("seq")
+    if seq is not None:
+        return seq, sensor.outstanding.get(seq)
+    for seq, pending in sensor.outstanding.items():  # server without sequence numbers
+        if pending.message["header"]["time_stamp"] == header["time_stamp"]:
+            return seq, pending
+    return None, None
+
+def send_batched(client, entries, fmt):
+    global batch_seq
+    
+    for batch in messages.split_batch(GATEWAY_ID, entries, fmt):
+        with LOCK:
+            batch_seq += 1
+            batches[batch_seq] = [(entry["sensor_id"], entry["seq"]) for entry in batch]
+            if len(batches) > MAX_BATCHES:
+                del batches[next(iter(batches))]
+            msg = messages.batch_message(GATEWAY_ID, batch, fmt, batch_seq)
+        client.send_message(msg)
+
+def corrupt(msg, fmt):
+    if fmt == "binary" or fmt == "delta":
+        return msg[:-1] + bytes([msg[-1] ^ 0xFF]) # flip crc trailer
+    if fmt == "json":
+        return msg[:-messages.CRC_TRAILER_SIZE] + "|00000000"
+    json_msg = messages.json_decode(msg)
+    json_msg["header"]["crc"] = "0"
+    return messages.json_encode(json_msg)
 
 def create_data(sensor_id): #param1, param2, param3, param4
-    if sensor_id == "ThermoNode":
+    kind = messages.sensor_type(sensor_id)
+    
+    if kind == "ThermoNode":
         message = {
             "temperature": round(random.uniform(-50.0, 60.0), 1),
             "humidity": round(random.uniform(0.0, 100.0), 1),
@@ -113,7 +168,7 @@ def create_data(sensor_id): #param1, param2, param3, param4
             "pressure": round(random.uniform(800.00, 1100.00), 2) 
         }
         
-    elif sensor_id == "WindSense":
+    elif kind == "WindSense":
         message = {
             "wind_speed": round(random.uniform(0, 50), 1),
             "wind_gust": round(random.uniform(0, 70), 1),
@@ -121,7 +176,7 @@ def create_data(sensor_id): #param1, param2, param3, param4
             "turbulence": round(random.uniform(0, 1), 1)
         }
         
-    elif sensor_id == "RainDetect":
+    elif kind == "RainDetect":
         message = {
             "rainfall": round(random.uniform(0, 500), 1),
             "soil_moisture": round(random.uniform(0, 100), 1),
@@ -129,7 +184,7 @@ def create_data(sensor_id): #param1, param2, param3, param4
             "rain_duration": random.randint(0,60)
         }
         
-    elif sensor_id == "AirQualityBox":
+    elif kind == "AirQualityBox":
         message = {
             "co2": random.randint(300,5000),
             "ozone": round(random.uniform(0,500), 1),
@@ -141,32 +196,50 @@ def create_data(sensor_id): #param1, param2, param3, param4
     
 
 def auto_send_data(client):
-    global unix_time
     time.sleep(10)
     
     while True:
         
-        unix_time = int(time.time())
+        time.sleep(max(slow_until - time.monotonic(), 0))
         
-        for key, value in sensors.items():
+        entries = []
+        outgoing = []
+        fmt = "json"
+        
+        for key, sensor in list(sensors.items()):
             
             with LOCK:
         
-                token, battery, last_msg, active, ack = value
-                if token != None and active:
+                if sensor.token != None and sensor.active and len(sensor.outstanding) < MAX_IN_FLIGHT:
             
                     dataflow = create_data(key)
-                    msg = messages.sensor_message(key, value[0], dataflow, battery, "data", 0)
+                    sensor.seq += 1
+                    
+                    if batching and sensor.format != "legacy":
+                        entry = messages.reading(key, sensor.token, dataflow, sensor.battery, sensor.seq)
+                        track(key, sensor, {"header": dict(entry, msg_type="data", crc="")})
+                        entries.append(entry)
+                        fmt = sensor.format
+                        continue
+                    
+                    msg = messages.sensor_message(key, sensor.token, dataflow, sensor.battery, "data", 0, sensor.format, sensor.seq)
                 
-                    sensors[key][2].append(json.loads(msg))
-                    sensors[key][4].append(0)
-                    client.send_message(msg)
+                    track(key, sensor, process_message(msg))
+                    outgoing.append(msg)
+        
+        # sent outside LOCK so ACK handling never waits on the socket
+        for msg in outgoing:
+            client.send_message(msg)
+        
+        if entries:
+            send_batched(client, entries, fmt)
                 
 
                 
         time.sleep(15)
         
 def receive_data(client):
+    global slow_until
     
     inactivity_counter = 0
     
@@ -179,22 +252,34 @@ def receive_data(client):
         
         json_msg = process_message(msg)
         
+        if json_msg is not None and json_msg["header"]["msg_type"] == "batch_ack":
+            bitmap = json_msg["header"]["data"]["batch"]
+            with LOCK:
+                for i, (sensor_id, seq) in enumerate(batches.pop(json_msg["header"].get("seq"), ())):
+                    if bitmap >> i & 1 and sensor_id in sensors:
+                        sensors[sensor_id].outstanding.pop(seq, None)
+            continue
+        
+        if json_msg is not None and json_msg["header"]["msg_type"] == "slow_down":
+            slow_until = time.monotonic() + json_msg["header"]["data"]["slow_down"]
+            continue
+        
+        if json_msg is None or json_msg["header"]["sensor_id"] not in sensors:
+            continue
+        
+        reply = None
+        
         with LOCK:
             if json_msg["header"]["msg_type"] == "error":
                 
-                sensor = json_msg["header"]["sensor_id"]
-                time_stamp = json_msg["header"]["time_stamp"]
+                sensor = sensors[json_msg["header"]["sensor_id"]]
+                seq, pending = find_pending(sensor, json_msg["header"])
                 
-                for corrupted_message in sensors[sensor][2]:        # sent messages
-                    if corrupted_message["header"]["time_stamp"] == time_stamp:
-                        
-                        corrupted_message["header"]["crc"] = ""
-                        corrupted_message["header"]["msg_type"] = "error"
-                        corrupted_string = json.dumps(corrupted_message,separators=(",", ":"), sort_keys=True)
-                        checksum = CRC_CALCULATOR.checksum(corrupted_string.encode("utf-8"))
-                        corrupted_message["header"]["crc"] = checksum
-                        corrupted_message = json.dumps(corrupted_message, separators=(",", ":"), sort_keys=True)
-                        client.send_message(corrupted_message)
+                if pending is not None:
+                    corrupted_message = pending.message
+                    corrupted_message["header"]["crc"] = ""
+                    corrupted_message["header"]["msg_type"] = "error"
+                    reply = messages.dump(corrupted_message, sensor.format)
             
             elif json_msg["header"]["msg_type"] == "activity":
                 sensor_id = json_msg["header"]["sensor_id"]
@@ -202,24 +287,23 @@ def receive_data(client):
                 
                 inactivity_counter += 1
                 
-                if not sensor[3] and inactivity_counter >= 2:
-                    sensor[3] = 1
+                if not sensor.active and inactivity_counter >= 2:
+                    sensor.active = 1
                     token = json_msg["header"]["token"]
-                    battery = sensor[1]
-                    msg = messages.sensor_message(sensor_id, token, {"active": 1}, battery, "activity", 0)
-                    client.send_message(msg)
+                    battery = sensor.battery
+                    reply = messages.sensor_message(sensor_id, token, {"active": 1}, battery, "activity", 0, sensor.format)
                     inactivity_counter = 0
             
             elif json_msg["header"]["msg_type"] == "ack":
                 
-                sensor_id = json_msg["header"]["sensor_id"]
-                
-                token, battery, last_msg, active, ack = sensors[sensor_id]
+                sensor = sensors[json_msg["header"]["sensor_id"]]
+                seq, pending = find_pending(sensor, json_msg["header"])
                 
-                for i in range(len(ack)):
-                    if ack[i] == 0:
-                        if last_msg[i]["header"]["time_stamp"] == json_msg["header"]["time_stamp"]:
-                            ack[i] = 1
+                if pending is not None:
+                    del sensor.outstanding[seq]
+        
+        if reply is not None:
+            client.send_message(reply)
                         
                 
                      
@@ -227,22 +311,34 @@ def ack_data(client):
     
     while True:
         
-        for key, value in sensors.items():
-            
-            with LOCK:
-                token, battery, last_msg, active, ack = value
+        now = time.monotonic()
+        outgoing = []
+        
+        with LOCK:
+            while retransmits and retransmits[0][0] <= now and slow_until <= now:
+                due, sensor_id, seq = heapq.heappop(retransmits)
+                sensor = sensors.get(sensor_id)
+                pending = sensor.outstanding.get(seq) if sensor is not None else None
                 
-                for i in range(len(ack)):
-                    
-                    time_stamp = last_msg[i]["header"]["time_stamp"]
+                if pending is None or pending.due != due:   # acked or rescheduled
+                    continue
                 
-                    if ack[i] == 0 and unix_time - time_stamp > 1:
-                        
-                        msg_string = json.dumps(last_msg[i], separators=(",", ":"), sort_keys=True)
-                    
-                        client.send_message(msg_string)
+                if pending.attempts >= MAX_ATTEMPTS:
+                    del sensor.outstanding[seq]
+                    continue
+                
+                pending.attempts += 1
+                pending.due = now + min(RETRANSMIT_TIMEOUT * 2 ** pending.attempts, MAX_BACKOFF)
+                heapq.heappush(retransmits, (pending.due, sensor_id, seq))
+                
+                outgoing.append(messages.dump(pending.message, sensor.format))
+            
+            delay = retransmits[0][0] - now if retransmits else RETRANSMIT_TIMEOUT
+        
+        for msg in outgoing:
+            client.send_message(msg)
                     
-        time.sleep(5)
+        time.sleep(min(max(delay, 0.05), RETRANSMIT_TIMEOUT))
                 
                 
                        
@@ -263,7 +359,7 @@ if __name__=="__main__":
             
             if client != None:
                 
-                for sensor_id in sensors:
+                for sensor_id in sensor_ids():
                     register(sensor_id, client)
                 
                 threading.Thread(target=auto_send_data,args=(client,), daemon=True).start()
@@ -273,17 +369,20 @@ if __name__=="__main__":
             else:
                 print(f"{'\033[32m'} IPs and ports not configured!{'\033[0m'} ")
         
+        elif choice == "4":
+            
+            batching = not batching
+            print(f"{'\033[32m'} batched sending {'on' if batching else 'off'}{'\033[0m'} ")
+        
         elif choice == "3":
             
             if client != None:
                 print(" --- Select sensor --- \n")
                 i = 1
                 
-                for key, value in sensors.items():
-                    
-                    token, battery, last_msg, active, ack = value
+                for key, sensor in sensors.items():
                     
-                    if token != None:
+                    if sensor.token != None:
                         
                         print(f" {i}. {key} \n")
                         i += 1
@@ -310,21 +409,22 @@ if __name__=="__main__":
                 while typechoice not in options:
                     typechoice = input(" Input your choice: ")
             
+                sensor = sensors[sensorchoice]
+                
                 if typechoice == "1":
-                    sensors[sensorchoice][1] = "low"
+                    sensor.battery = "low"
                     
                 elif typechoice == "2":
                     dataflow = create_data(sensorchoice)
-                    token, battery, last_msg, active, ack = sensors[sensorchoice]
-                    corrupted_msg = messages.sensor_message(sensorchoice, token, dataflow, battery, "data", 0)
-                    json_msg = json.loads(corrupted_msg)
-                    json_msg["header"]["crc"] = "0"
-                    msg = json.dumps(json_msg, separators=(",", ":"))
-                    sensors[sensorchoice][2].append(json.loads(msg))
+                    with LOCK:
+                        sensor.seq += 1
+                        corrupted_msg = messages.sensor_message(sensorchoice, sensor.token, dataflow, sensor.battery, "data", 0, sensor.format, sensor.seq)
+                        track(sensorchoice, sensor, process_message(corrupted_msg))
+                    msg = corrupt(corrupted_msg, sensor.format)
                     client.send_message(msg)
                     
                 elif typechoice == "3":
-                    sensors[sensorchoice][3] = 0 # active = 0
+                    sensor.active = 0 # active = 0
                     
                     
                     